@@ -1,12 +1,21 @@
 import os
-from urllib.parse import urlparse
+from urllib.parse import urlparse, quote
 db_url = os.environ.get("DATABASE_URL")
 if db_url and db_url.startswith("postgres://"):
     db_url = db_url.replace("postgres://", "postgresql://", 1)
     os.environ["DATABASE_URL"] = db_url
 import re
 import mimetypes
+import hashlib
+import multiprocessing
+import hmac
 import json
+import heapq
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 from datetime import datetime, timezone, timedelta
 
 from flask import (
@@ -16,23 +25,34 @@ from flask import (
 from flask_sqlalchemy import SQLAlchemy
 from flask_socketio import SocketIO, emit, join_room
 from werkzeug.middleware.proxy_fix import ProxyFix
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
 from sqlalchemy import or_, and_, func, case
-from sqlalchemy.orm import joinedload
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload, aliased
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 
 # Web Push (اختياري)
 try:
     from pywebpush import webpush, WebPushException
+    from py_vapid import Vapid
+    import requests
+    from requests.adapters import HTTPAdapter
 except Exception:  # pragma: no cover
     webpush = None
     WebPushException = Exception
+    Vapid = None
+    requests = None
+    HTTPAdapter = None
 
 # Fallback VAPID key generation/storage.
 # Web Push requires VAPID_PUBLIC_KEY and VAPID_PRIVATE_KEY.
 # If they are not provided via environment variables, we generate them once
 # and store them under instance/vapid_keys.json.
+try:
+    from media_derivatives import render_image_derivatives
+except Exception:  # pragma: no cover - Pillow not installed
+    render_image_derivatives = None
+
 try:
     from cryptography.hazmat.primitives.asymmetric import ec
     from cryptography.hazmat.primitives import serialization
@@ -102,6 +122,20 @@ app.config["MEDIA_IMAGE_FOLDER"] = os.environ.get("MEDIA_IMAGE_FOLDER", os.path.
 app.config["MEDIA_AUDIO_FOLDER"] = os.environ.get("MEDIA_AUDIO_FOLDER", os.path.join("instance","uploads","audio"))
 app.config["MEDIA_FILE_FOLDER"] = os.environ.get("MEDIA_FILE_FOLDER", os.path.join("instance","uploads","files"))
 app.config["MAX_CONTENT_LENGTH"] = 25 * 1024 * 1024  # 25MB
+MEDIA_HASH_CHUNK_BYTES = 64 * 1024
+# Let the reverse proxy send media bytes after serve_media authorizes the request:
+#   ""           -> Python sends the file (Range / ETag / If-Modified-Since aware)
+#   "x-accel"    -> nginx: X-Accel-Redirect to MEDIA_ACCEL_PREFIX/<category>/<file>, e.g.
+#                   location /_protected_media/ { internal; alias /app/instance/uploads/; }
+#   "x-sendfile" -> Apache mod_xsendfile / lighttpd: X-Sendfile with the absolute path
+app.config["MEDIA_OFFLOAD"] = os.environ.get("MEDIA_OFFLOAD", "").strip().lower()
+app.config["MEDIA_ACCEL_PREFIX"] = os.environ.get("MEDIA_ACCEL_PREFIX", "/_protected_media")
+MEDIA_THUMB_WORKERS = max(0, int(os.environ.get("MEDIA_THUMB_WORKERS", "2")))  # 0 disables image derivatives
+MEDIA_DERIVATIVE_SIZES = (("s", 480), ("m", 1280))  # (suffix, longest edge in px): thumb_url, preview_url
+MEDIA_ACCESS_CACHE_SECONDS = 30  # how long a group membership answer is reused by serve_media
+# Signed media URLs stay identical within one window (so browsers can cache them) and
+# are valid for one to two windows
+MEDIA_URL_TTL_SECONDS = int(os.environ.get("MEDIA_URL_TTL_SECONDS", str(24 * 3600)))
 app.config["ALLOWED_EXTENSIONS"] = {"png", "jpg", "jpeg", "gif"}
 
 # Session cookies (improve security; safe defaults for prod)
@@ -123,12 +157,31 @@ socketio = SocketIO(
 
 online_users = {}
 
-CONVERSATION_PREVIEW_LIMIT = 10
+CONVERSATION_PAGE_LIMIT = 30
+CONVERSATION_PAGE_MAX = 100
 MESSAGE_PAGE_LIMIT = 50
+MESSAGE_PAGE_MAX = 200
+SUMMARY_PREVIEW_LEN = 200
+
+# Web Push dispatch: jobs are persisted in push_jobs and sent by a bounded worker pool
+PUSH_WORKERS = max(1, int(os.environ.get("PUSH_WORKERS", "4")))
+PUSH_DEVICE_WORKERS = max(1, int(os.environ.get("PUSH_DEVICE_WORKERS", "8")))  # concurrent sends to devices
+PUSH_MAX_ATTEMPTS = 5
+PUSH_RETRY_BASE_SECONDS = 5
+PUSH_POLL_SECONDS = 5
+PUSH_STALE_SECONDS = 120
+PUSH_TTL_SECONDS = int(os.environ.get("PUSH_TTL_SECONDS", str(24 * 3600)))  # push services drop older undelivered pushes
+# Pushes for the same (recipient, conversation) within this window collapse into one
+PUSH_COALESCE_SECONDS = float(os.environ.get("PUSH_COALESCE_SECONDS", "5"))
+# Keep-alive HTTP pools to push services (one requests.Session per origin)
+PUSH_HTTP_POOL_SIZE = max(1, int(os.environ.get("PUSH_HTTP_POOL_SIZE", "10")))
+PUSH_HTTP_CONNECT_TIMEOUT = float(os.environ.get("PUSH_HTTP_CONNECT_TIMEOUT", "5"))
+PUSH_HTTP_READ_TIMEOUT = float(os.environ.get("PUSH_HTTP_READ_TIMEOUT", "10"))
 
 
 # ----------------- Helpers -----------------
 PHONE_RE = re.compile(r"^\+?[0-9]{10,15}$")
+MENTION_RE = re.compile(r"@\+?[0-9]{10,15}")
 
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in app.config["ALLOWED_EXTENSIONS"]
@@ -175,53 +228,122 @@ def _utc_iso(dt: Union[datetime, None]) -> Union[str, None]:
     return dt.isoformat().replace("+00:00", "Z")
 
 
-def _serialize_message(msg, sender_name: Optional[str] = None) -> dict:
-    if sender_name is None:
-        sender = getattr(msg, "sender", None)
-        if not sender:
-            sender = db.session.get(User, getattr(msg, "sender_id", None))
-        sender_name = sender.name if sender else ""
-    payload = {
-        "id": msg.id,
-        "sender_id": getattr(msg, "sender_id", None),
-        "receiver_id": getattr(msg, "receiver_id", None),
-        "group_id": getattr(msg, "group_id", None),
-        "sender_name": sender_name or "",
-        "content": msg.content,
-        "timestamp_iso": _utc_iso(msg.timestamp),
-        "timestamp_ms": _utc_ms(msg.timestamp),
-        "message_type": getattr(msg, "message_type", "text"),
-        "media_url": getattr(msg, "media_url", None),
-        "media_mime": getattr(msg, "media_mime", None),
-        "is_read": getattr(msg, "is_read", False),
-        "delivered_at": _utc_iso(getattr(msg, "delivered_at", None)),
-        "read_at": _utc_iso(getattr(msg, "read_at", None)),
-        "edited_at": _utc_iso(getattr(msg, "edited_at", None)),
-        "deleted_for_all": bool(getattr(msg, "deleted_for_all", False)),
-        "reply_to_id": getattr(msg, "reply_to_id", None),
-        "forwarded": bool(getattr(msg, "forwarded", False)),
+def _dm_conversation_key(user_a: int, user_b: int) -> str:
+    """Canonical DM conversation key ("<min_id>:<max_id>"), same for both directions."""
+    lo, hi = sorted((int(user_a), int(user_b)))
+    return f"{lo}:{hi}"
+
+
+def _conversation_key_default(context) -> str:
+    params = context.get_current_parameters()
+    return _dm_conversation_key(params["sender_id"], params["receiver_id"])
+
+
+def _media_signature(path: str, user_id: int, expires: int) -> str:
+    key = app.secret_key.encode() if isinstance(app.secret_key, str) else app.secret_key
+    return hmac.new(key, f"{path}|{int(user_id)}|{int(expires)}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def _signed_media_url(media_url: Optional[str], user_id: Optional[int]) -> Optional[str]:
+    """media_url with an expiring signature for user_id; serve_media checks it without the DB."""
+    if not media_url or not user_id or not media_url.startswith("/media/"):
+        return media_url
+    expires = (int(time.time()) // MEDIA_URL_TTL_SECONDS + 2) * MEDIA_URL_TTL_SECONDS
+    sig = _media_signature(media_url, user_id, expires)
+    return f"{media_url}?u={int(user_id)}&e={expires}&s={sig}"
+
+
+def _media_url_fields(msg, viewer_id: Optional[int]) -> dict:
+    return {
+        "media_url": _signed_media_url(getattr(msg, "media_url", None), viewer_id),
+        "thumb_url": _signed_media_url(getattr(msg, "thumb_url", None), viewer_id),
+        "preview_url": _signed_media_url(getattr(msg, "preview_url", None), viewer_id),
     }
 
-    # Best-effort: include reply snippet to render quote in UI
+
+def _serialize_message(msg, sender_name: Optional[str] = None, viewer_id: Optional[int] = None) -> dict:
+    names = {getattr(msg, "sender_id", None): sender_name} if sender_name is not None else None
+    return _serialize_messages([msg], sender_names=names, viewer_id=viewer_id)[0]
+
+
+def _serialize_messages(msgs, sender_names: Optional[dict] = None, viewer_id: Optional[int] = None) -> list[dict]:
+    """Serialize a batch of Message/GroupMessage rows with a constant number of queries.
+
+    Reply targets are prefetched with one IN query per message table, and the names of
+    all senders (including senders of quoted replies) with one IN query on users.
+    With viewer_id, media URLs are signed for that user (see _signed_media_url).
+    """
+    msgs = list(msgs)
+    if not msgs:
+        return []
+
+    # Best-effort: prefetch reply targets to render quotes in UI
+    dm_reply_ids = set()
+    group_reply_ids = set()
+    for m in msgs:
+        rtid = getattr(m, "reply_to_id", None)
+        if not rtid:
+            continue
+        if getattr(m, "group_id", None) is not None:
+            group_reply_ids.add(int(rtid))
+        else:
+            dm_reply_ids.add(int(rtid))
+    replies = {}
     try:
+        if dm_reply_ids:
+            for rm in Message.query.filter(Message.id.in_(sorted(dm_reply_ids))).all():
+                replies[("dm", int(rm.id))] = rm
+        if group_reply_ids:
+            for rm in GroupMessage.query.filter(GroupMessage.id.in_(sorted(group_reply_ids))).all():
+                replies[("group", int(rm.id))] = rm
+    except SQLAlchemyError:
+        replies = {}
+
+    names = dict(sender_names or {})
+    missing = {
+        int(sid)
+        for sid in [getattr(m, "sender_id", None) for m in msgs] + [getattr(r, "sender_id", None) for r in replies.values()]
+        if sid is not None and sid not in names
+    }
+    if missing:
+        names.update(dict(db.session.query(User.id, User.name).filter(User.id.in_(sorted(missing))).all()))
+
+    out = []
+    for msg in msgs:
+        payload = {
+            "id": msg.id,
+            "sender_id": getattr(msg, "sender_id", None),
+            "receiver_id": getattr(msg, "receiver_id", None),
+            "group_id": getattr(msg, "group_id", None),
+            "sender_name": names.get(getattr(msg, "sender_id", None)) or "",
+            "content": msg.content,
+            "timestamp_iso": _utc_iso(msg.timestamp),
+            "timestamp_ms": _utc_ms(msg.timestamp),
+            "message_type": getattr(msg, "message_type", "text"),
+            **_media_url_fields(msg, viewer_id),
+            "media_mime": getattr(msg, "media_mime", None),
+            "media_width": getattr(msg, "media_width", None),
+            "media_height": getattr(msg, "media_height", None),
+            "is_read": getattr(msg, "is_read", False),
+            "delivered_at": _utc_iso(getattr(msg, "delivered_at", None)),
+            "read_at": _utc_iso(getattr(msg, "read_at", None)),
+            "edited_at": _utc_iso(getattr(msg, "edited_at", None)),
+            "deleted_for_all": bool(getattr(msg, "deleted_for_all", False)),
+            "reply_to_id": getattr(msg, "reply_to_id", None),
+            "forwarded": bool(getattr(msg, "forwarded", False)),
+        }
         rtid = getattr(msg, "reply_to_id", None)
         if rtid:
-            is_group = getattr(msg, "group_id", None) is not None
-            if is_group:
-                rm = db.session.get(GroupMessage, int(rtid))
-            else:
-                rm = db.session.get(Message, int(rtid))
+            kind = "group" if getattr(msg, "group_id", None) is not None else "dm"
+            rm = replies.get((kind, int(rtid)))
             if rm and not bool(getattr(rm, "deleted_for_all", False)):
-                rsender = getattr(rm, "sender", None) or db.session.get(User, getattr(rm, "sender_id", None))
                 payload["reply_to"] = {
                     "id": int(rm.id),
-                    "sender_name": (rsender.name if rsender else ""),
+                    "sender_name": names.get(getattr(rm, "sender_id", None)) or "",
                     "content": (getattr(rm, "content", "") or "")[:400],
                 }
-    except Exception:
-        pass
-
-    return payload
+        out.append(payload)
+    return out
 
 
 def _emit_direct_message(msg):
@@ -239,15 +361,76 @@ def _emit_direct_message(msg):
     except Exception:
         db.session.rollback()
 
-    payload = _serialize_message(msg)
-    socketio.emit("new_message", {"type": "dm", "message": payload}, room=f"user_{msg.receiver_id}")
-    socketio.emit("refresh_unread", {"type": "dm", "message_id": msg.id}, room=f"user_{msg.receiver_id}")
+    payload = _serialize_message(msg, viewer_id=msg.sender_id)
+    to_receiver = {**payload, **_media_url_fields(msg, msg.receiver_id)}
+    socketio.emit("new_message", {"type": "dm", "message": to_receiver}, room=f"user_{msg.receiver_id}")
+    last_ts = payload.get("timestamp_ms")
+    to_self = int(msg.sender_id) == int(msg.receiver_id)
+    _emit_unread_update(f"user_{msg.receiver_id}", "dm", msg.sender_id, delta=0 if to_self else 1, last_ts=last_ts)
+    if not to_self:
+        # the sender's other tabs only move the conversation up
+        _emit_unread_update(f"user_{msg.sender_id}", "dm", msg.receiver_id, delta=0, last_ts=last_ts)
+    return payload
+
+
+def _group_online_member_ids(group_id: int) -> list:
+    """Accepted, unblocked members of the group that have a socket in this process."""
+    online = list(online_users.keys())
+    if not online:
+        return []
+    blocked = db.select(GroupBlock.id).where(GroupBlock.group_id == GroupMember.group_id, GroupBlock.user_id == GroupMember.user_id)
+    return list(db.session.execute(
+        db.select(GroupMember.user_id).where(
+            GroupMember.group_id == int(group_id),
+            GroupMember.status == "accepted",
+            GroupMember.user_id.in_(online),
+            ~blocked.exists(),
+        )
+    ).scalars())
 
 
 def _emit_group_message(msg):
     payload = _serialize_message(msg)
-    socketio.emit("new_message", {"type": "group", "message": payload}, room=f"group_{msg.group_id}")
-    socketio.emit("refresh_unread", {"type": "group", "group_id": msg.group_id}, room=f"group_{msg.group_id}")
+    if getattr(msg, "media_url", None):
+        # Media URLs are signed per member, so each online member gets its own copy
+        for uid in _group_online_member_ids(msg.group_id):
+            message = {**payload, **_media_url_fields(msg, uid)}
+            socketio.emit("new_message", {"type": "group", "message": message}, room=f"user_{uid}")
+    else:
+        socketio.emit("new_message", {"type": "group", "message": payload}, room=f"group_{msg.group_id}")
+    # Clients skip the +1 when sender_id is themselves
+    _emit_unread_update(
+        f"group_{msg.group_id}", "group", msg.group_id,
+        delta=1, last_ts=payload.get("timestamp_ms"), sender_id=int(msg.sender_id),
+    )
+    return {**payload, **_media_url_fields(msg, msg.sender_id)}
+
+
+def _emit_message_media(msg):
+    """Tell open chats that an image message got its thumbnail/preview (URLs signed per viewer)."""
+    if isinstance(msg, GroupMessage):
+        kind, viewers = "group", _group_online_member_ids(msg.group_id)
+    else:
+        kind, viewers = "dm", {int(msg.sender_id), int(msg.receiver_id)}
+    for uid in viewers:
+        urls = _media_url_fields(msg, uid)
+        socketio.emit("message_media", {
+            "type": kind,
+            "message_id": int(msg.id),
+            "thumb_url": urls["thumb_url"],
+            "preview_url": urls["preview_url"],
+            "media_width": msg.media_width,
+            "media_height": msg.media_height,
+        }, room=f"user_{uid}")
+
+
+def _emit_unread_update(room: str, conv_type: str, conv_id: int, **fields):
+    """Push one conversation's badge change to a room.
+
+    fields: delta (+n to add), unread (absolute value, sent on read), last_ts (ms),
+    sender_id. Clients apply these in place instead of refetching /api/unread_counts.
+    """
+    socketio.emit("unread_delta", {"type": conv_type, "id": int(conv_id), **fields}, room=room)
 
 
 def _mark_user_online(user_id: int):
@@ -266,57 +449,368 @@ def _mark_user_offline(user_id: int):
         online_users[user_id] = count
 
 
-def _load_group_activity(uid: int):
-    memberships = GroupMember.query.filter_by(user_id=uid, status="accepted").all()
-    if not memberships:
-        return {}, {}
+def _load_conversation_activity(uid: int):
+    """Unread counts and last activity per conversation, read from conversation_summary.
 
-    group_ids = [m.group_id for m in memberships]
-    blocked_ids = {
-        gid
-        for (gid,) in db.session.query(GroupBlock.group_id)
-        .filter(GroupBlock.user_id == uid, GroupBlock.group_id.in_(group_ids))
+    Returns (user_counts, group_counts, last_ts_users, last_ts_groups). Only DMs with
+    unread messages appear in user_counts; every active (accepted, not blocked) group
+    appears in group_counts.
+    """
+    active_group_ids = [
+        int(gid) for (gid,) in (
+            db.session.query(GroupMember.group_id)
+            .outerjoin(GroupBlock, and_(GroupBlock.group_id == GroupMember.group_id, GroupBlock.user_id == uid))
+            .filter(
+                GroupMember.user_id == uid,
+                GroupMember.status == "accepted",
+                GroupBlock.id == None  # noqa: E711
+            )
+            .all()
+        )
+    ]
+    user_counts, last_ts_users = {}, {}
+    group_counts = {gid: 0 for gid in active_group_ids}
+    last_ts_groups = {}
+
+    rows = (
+        db.session.query(
+            ConversationSummary.conversation_type,
+            ConversationSummary.conversation_id,
+            ConversationSummary.unread_count,
+            ConversationSummary.last_message_at,
+        )
+        .filter(ConversationSummary.user_id == uid)
         .all()
-    }
-    active_group_ids = [gid for gid in group_ids if gid not in blocked_ids]
-    if not active_group_ids:
-        return {}, {}
-
-    group_counts = {int(gid): 0 for gid in active_group_ids}
-    last_read_expr = func.coalesce(
-        GroupMember.last_read_at,
-        GroupMember.responded_at,
-        GroupMember.invited_at,
     )
-    rows = (
-        db.session.query(GroupMessage.group_id, func.count(GroupMessage.id))
-        .join(GroupMember, GroupMember.group_id == GroupMessage.group_id)
-        .filter(
+    for conv_type, conv_id, unread, last_at in rows:
+        conv_id = int(conv_id)
+        if conv_type == "dm":
+            if unread:
+                user_counts[conv_id] = int(unread)
+            if last_at:
+                last_ts_users[conv_id] = _utc_ms(last_at)
+        elif conv_id in group_counts:
+            group_counts[conv_id] = int(unread or 0)
+            if last_at:
+                last_ts_groups[conv_id] = _utc_ms(last_at)
+
+    return user_counts, group_counts, last_ts_users, last_ts_groups
+
+
+_CONV_EPOCH = datetime(1970, 1, 1)
+_CONV_NO_PIN = 10**9
+
+
+def _conversation_setting_cols(cs):
+    return (
+        case((cs.is_archived == True, 1), else_=0).label("archived"),  # noqa: E712
+        func.coalesce(cs.pinned_rank, _CONV_NO_PIN).label("pin"),
+        cs.muted_until.label("muted_until"),
+    )
+
+
+def _conversation_groups_select(uid: int):
+    """uid's accepted, unblocked groups with their sort keys (bounded by uid's memberships).
+
+    Groups without messages have no summary row and sort by created_at.
+    """
+    gsum, gset = aliased(ConversationSummary), aliased(ConversationSetting)
+    newer, newer_member = aliased(Group), aliased(GroupMember)
+
+    # Same name + same owner: only the newest copy is listed
+    duplicate = (
+        db.select(newer.id)
+        .join(newer_member, and_(
+            newer_member.group_id == newer.id,
+            newer_member.user_id == uid,
+            newer_member.status == "accepted",
+        ))
+        .where(
+            newer.owner_id == Group.owner_id,
+            newer.id > Group.id,
+            func.lower(func.trim(newer.name)) == func.lower(func.trim(Group.name)),
+        )
+        .exists()
+    )
+    return (
+        db.select(
+            db.literal("group").label("kind"),
+            Group.id.label("cid"),
+            Group.name.label("name"),
+            Group.owner_id.label("owner_id"),
+            db.null().label("profile_pic"),
+            db.null().label("phone_number"),
+            func.coalesce(gsum.unread_count, 0).label("unread"),
+            func.coalesce(gsum.last_message_at, Group.created_at).label("sort_ts"),
+            *_conversation_setting_cols(gset),
+        )
+        .join(GroupMember, GroupMember.group_id == Group.id)
+        .outerjoin(GroupBlock, and_(GroupBlock.group_id == Group.id, GroupBlock.user_id == uid))
+        .outerjoin(gsum, and_(gsum.user_id == uid, gsum.conversation_type == "group", gsum.conversation_id == Group.id))
+        .outerjoin(gset, and_(gset.user_id == uid, gset.conversation_type == "group", gset.conversation_id == Group.id))
+        .where(
             GroupMember.user_id == uid,
             GroupMember.status == "accepted",
-            GroupMessage.group_id.in_(active_group_ids),
-            GroupMessage.sender_id != uid,
-            GroupMessage.timestamp > last_read_expr,
+            GroupBlock.id == None,  # noqa: E711
+            ~duplicate,
         )
-        .group_by(GroupMessage.group_id)
-        .all()
     )
-    for gid, cnt in rows:
-        group_counts[int(gid)] = int(cnt)
 
-    last_ts_groups = {}
-    rows = (
-        db.session.query(GroupMessage.group_id, func.max(GroupMessage.timestamp))
-        .filter(GroupMessage.group_id.in_(active_group_ids))
-        .group_by(GroupMessage.group_id)
-        .all()
+
+def _conversation_users_select(uid: int, source=None):
+    """Other users as sidebar entries.
+
+    source="summary": users uid has a DM summary row with, driven from conversation_summary;
+    "setting": users with only a settings row (pinned/archived before any message);
+    "rest": users with neither; None: no filter (a single lookup).
+    """
+    dsum, dset = aliased(ConversationSummary), aliased(ConversationSetting)
+    cols = (
+        db.literal("user").label("kind"),
+        User.id.label("cid"),
+        User.name.label("name"),
+        db.null().label("owner_id"),
+        User.profile_pic.label("profile_pic"),
+        User.phone_number.label("phone_number"),
+        func.coalesce(dsum.unread_count, 0).label("unread"),
+        func.coalesce(dsum.last_message_at, _CONV_EPOCH).label("sort_ts"),
+        *_conversation_setting_cols(dset),
     )
-    for gid, mx in rows:
-        if gid is None or mx is None:
-            continue
-        last_ts_groups[int(gid)] = int(mx.timestamp() * 1000)
+    on_sum = and_(dsum.user_id == uid, dsum.conversation_type == "dm", dsum.conversation_id == User.id)
+    on_set = and_(dset.user_id == uid, dset.conversation_type == "dm", dset.conversation_id == User.id)
+    if source == "summary":
+        q = db.select(*cols).select_from(dsum).join(User, on_sum).outerjoin(dset, on_set)
+    elif source == "setting":
+        q = (
+            db.select(*cols).select_from(dset).join(User, on_set).outerjoin(dsum, on_sum)
+            .where(dsum.id == None)  # noqa: E711
+        )
+    else:
+        q = db.select(*cols).select_from(User).outerjoin(dsum, on_sum).outerjoin(dset, on_set)
+        if source == "rest":
+            q = q.where(dsum.id == None, dset.id == None)  # noqa: E711
+    return q.where(User.id != uid)
+
+
+def _conversation_cursor(row) -> str:
+    us = (row.sort_ts - _CONV_EPOCH) // timedelta(microseconds=1)
+    return f"{int(row.archived)}.{int(row.pin)}.{us}.{row.kind}.{int(row.cid)}"
+
+
+def _parse_conversation_cursor(raw):
+    """Decode a cursor from _conversation_page; None if it is malformed.
+
+    "n.<user_id>" points into the trailing never-messaged users, anything else is
+    the (archived, pin, sort_ts, kind, cid) key of a conversation.
+    """
+    try:
+        parts = str(raw).split(".")
+        if len(parts) == 2 and parts[0] == "n":
+            return ("n", int(parts[1]))
+        archived, pin, us, kind, cid = parts
+        if kind not in ("group", "user"):
+            return None
+        return int(archived), int(pin), _CONV_EPOCH + timedelta(microseconds=int(us)), kind, int(cid)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _conversation_page(uid: int, limit: int, cursor=None):
+    """Return (rows, next_cursor) for one page of uid's sidebar, ordered and cut in SQL.
+
+    uid's own conversations (DM summary/settings rows + accepted groups) come first,
+    sorted by (archived, pin, sort_ts desc, kind, cid desc); only that set is sorted,
+    never the users table. Other users follow by id desc once those run out.
+    """
+    rows = []
+    if not cursor or cursor[0] != "n":
+        sq = db.union_all(
+            _conversation_groups_select(uid),
+            _conversation_users_select(uid, "summary"),
+            _conversation_users_select(uid, "setting"),
+        ).subquery()
+        q = db.select(sq)
+        if cursor:
+            archived, pin, ts, kind, cid = cursor
+            # Keyset "after" for mixed sort directions
+            q = q.where(or_(
+                sq.c.archived > archived,
+                and_(sq.c.archived == archived, or_(
+                    sq.c.pin > pin,
+                    and_(sq.c.pin == pin, or_(
+                        sq.c.sort_ts < ts,
+                        and_(sq.c.sort_ts == ts, or_(
+                            sq.c.kind > kind,
+                            and_(sq.c.kind == kind, sq.c.cid < cid),
+                        )),
+                    )),
+                )),
+            ))
+        q = q.order_by(sq.c.archived.asc(), sq.c.pin.asc(), sq.c.sort_ts.desc(), sq.c.kind.asc(), sq.c.cid.desc())
+        rows = db.session.execute(q.limit(limit + 1)).all()
+        if len(rows) > limit:
+            return rows[:limit], _conversation_cursor(rows[limit - 1])
+
+    q = _conversation_users_select(uid, "rest")
+    if cursor and cursor[0] == "n":
+        q = q.where(User.id < cursor[1])
+    fresh = db.session.execute(q.order_by(User.id.desc()).limit(limit - len(rows) + 1)).all()
+    if len(rows) + len(fresh) > limit:
+        fresh = fresh[:limit - len(rows)]
+        if fresh:
+            return rows + fresh, f"n.{int(fresh[-1].cid)}"
+        return rows, _conversation_cursor(rows[-1]) if rows else None
+    return rows + fresh, None
+
+
+def _conversation_row(uid: int, kind: str, cid: int):
+    if kind == "group":
+        q = _conversation_groups_select(uid).where(Group.id == int(cid))
+    else:
+        q = _conversation_users_select(uid).where(User.id == int(cid))
+    return db.session.execute(q).first()
+
+
+def _serialize_conversation(row, uid: int) -> dict:
+    item = {
+        "type": row.kind,
+        "id": int(row.cid),
+        "name": row.name or "",
+        "unread": int(row.unread or 0),
+        "last_ms": _utc_ms(row.sort_ts) if row.sort_ts and row.sort_ts > _CONV_EPOCH else 0,
+        "pinned_rank": int(row.pin) if int(row.pin) != _CONV_NO_PIN else None,
+        "archived": bool(row.archived),
+        "muted_until": row.muted_until.isoformat() if row.muted_until else None,
+    }
+    if row.kind == "group":
+        item["owner_id"] = int(row.owner_id)
+        item["is_owner"] = int(row.owner_id) == int(uid)
+    else:
+        item["phone_number"] = row.phone_number or ""
+        item["avatar"] = url_for("static", filename="profile_pics/" + (row.profile_pic or "default.png"))
+    return item
 
-    return group_counts, last_ts_groups
+
+def _not_hidden_for(user_id: int, message_type: str, message_id_col):
+    """NOT EXISTS filter that drops messages the user deleted for themselves.
+
+    Served by the (message_type, message_id, user_id) unique index on message_visibility.
+    """
+    return ~(
+        db.session.query(MessageVisibility.id)
+        .filter(
+            MessageVisibility.message_type == message_type,
+            MessageVisibility.message_id == message_id_col,
+            MessageVisibility.user_id == int(user_id),
+            MessageVisibility.is_deleted_for_me == True,  # noqa: E712
+        )
+        .exists()
+    )
+
+
+def _parse_page_limit(raw, default: int = MESSAGE_PAGE_LIMIT, maximum: int = MESSAGE_PAGE_MAX, minimum: int = 20) -> int:
+    try:
+        limit = int(raw)
+    except (TypeError, ValueError):
+        limit = default
+    return max(minimum, min(limit, maximum))
+
+
+def _parse_cursor_id(raw) -> int:
+    try:
+        return max(int(raw or 0), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _keyset_page(query, model, limit: int, before_id: int = 0, after_id: int = 0, by_id: bool = False):
+    """Return (messages in ascending order, has_more) for one page of a conversation.
+
+    Pages are keyed on (timestamp, id), matching ix_group_messages_group_ts, or on id
+    alone when by_id is set (DMs, served by ix_messages_conv_key_id):
+      - after_id:  the `limit` messages right after the cursor (has_more = newer exist)
+      - before_id: the `limit` messages right before the cursor (has_more = older exist)
+      - neither:   the latest `limit` messages (has_more = older exist)
+    One extra row is fetched to compute has_more without a COUNT.
+    """
+    id_col = model.id
+    if by_id:
+        if after_id:
+            rows = query.filter(id_col > after_id).order_by(id_col.asc()).limit(limit + 1).all()
+            return rows[:limit], len(rows) > limit
+        if before_id:
+            query = query.filter(id_col < before_id)
+        rows = query.order_by(id_col.desc()).limit(limit + 1).all()
+        return list(reversed(rows[:limit])), len(rows) > limit
+
+    ts_col = model.timestamp
+    cursor_id = after_id or before_id
+    if cursor_id:
+        cursor_ts = db.session.query(ts_col).filter(id_col == cursor_id).scalar()
+        if after_id:
+            if cursor_ts is not None:
+                query = query.filter(or_(ts_col > cursor_ts, and_(ts_col == cursor_ts, id_col > cursor_id)))
+            else:
+                query = query.filter(id_col > cursor_id)
+        else:
+            if cursor_ts is not None:
+                query = query.filter(or_(ts_col < cursor_ts, and_(ts_col == cursor_ts, id_col < cursor_id)))
+            else:
+                query = query.filter(id_col < cursor_id)
+
+    if after_id:
+        rows = query.order_by(ts_col.asc(), id_col.asc()).limit(limit + 1).all()
+        return rows[:limit], len(rows) > limit
+
+    rows = query.order_by(ts_col.desc(), id_col.desc()).limit(limit + 1).all()
+    return list(reversed(rows[:limit])), len(rows) > limit
+
+
+def _mark_dm_read(reader_id: int, sender_id: int, now: datetime) -> list[int]:
+    """Mark all unread DMs from sender to reader as read with one UPDATE; return their ids.
+
+    Uses UPDATE ... RETURNING where the dialect supports it (Postgres, SQLite >= 3.35),
+    otherwise selects the ids first. No ORM objects are loaded either way.
+    """
+    t = Message.__table__
+    cond = and_(t.c.receiver_id == int(reader_id), t.c.sender_id == int(sender_id), t.c.is_read == False)  # noqa: E712
+    if getattr(db.engine.dialect, "update_returning", False):
+        rows = db.session.execute(t.update().where(cond).values(is_read=True, read_at=now).returning(t.c.id))
+        return sorted(int(mid) for (mid,) in rows)
+    ids = sorted(int(mid) for (mid,) in db.session.query(t.c.id).filter(cond).all())
+    if ids:
+        db.session.execute(t.update().where(t.c.id.in_(ids)).values(is_read=True, read_at=now))
+    return ids
+
+
+def _group_max_message_id(group_id: int) -> int:
+    mx = db.session.query(func.max(GroupMessage.id)).filter(GroupMessage.group_id == int(group_id)).scalar()
+    return int(mx or 0)
+
+
+def _advance_group_watermarks(member_id: int, message_id: int, read: bool = True):
+    """Move a member's delivered (and optionally read) watermark forward to message_id.
+
+    Single conditional UPDATE, so concurrent fetches from several tabs never move
+    a watermark backwards.
+    """
+    if not message_id:
+        return
+    mid = int(message_id)
+    values = {
+        "last_delivered_message_id": case(
+            (func.coalesce(GroupMember.last_delivered_message_id, 0) < mid, mid),
+            else_=GroupMember.last_delivered_message_id,
+        )
+    }
+    if read:
+        values["last_read_message_id"] = case(
+            (func.coalesce(GroupMember.last_read_message_id, 0) < mid, mid),
+            else_=GroupMember.last_read_message_id,
+        )
+    db.session.execute(
+        GroupMember.__table__.update().where(GroupMember.__table__.c.id == int(member_id)).values(**values)
+    )
 
 
 # ----------------- Models -----------------
@@ -362,6 +856,15 @@ class Message(db.Model):
     deleted_for_all = db.Column(db.Boolean, default=False, index=True)
     reply_to_id = db.Column(db.Integer, nullable=True, index=True)
     forwarded = db.Column(db.Boolean, default=False, index=True)
+    # Canonical "<min_id>:<max_id>" key so a DM thread is one (conversation_key, id) index range
+    conversation_key = db.Column(db.String(32), nullable=True, default=_conversation_key_default)
+    # Client-generated id so a retried send returns the stored row instead of a duplicate
+    client_msg_id = db.Column(db.String(64), nullable=True)
+    # Image derivatives, filled in by the thumbnail pool after upload
+    thumb_url = db.Column(db.Text, nullable=True)
+    preview_url = db.Column(db.Text, nullable=True)
+    media_width = db.Column(db.Integer, nullable=True)
+    media_height = db.Column(db.Integer, nullable=True)
 
     sender = db.relationship("User", foreign_keys=[sender_id], backref="sent_messages")
     receiver = db.relationship("User", foreign_keys=[receiver_id], backref="received_messages")
@@ -369,6 +872,8 @@ class Message(db.Model):
     __table_args__ = (
         db.Index("ix_messages_sender_receiver_ts", "sender_id", "receiver_id", "timestamp"),
         db.Index("ix_messages_receiver_is_read", "receiver_id", "is_read"),
+        db.Index("ix_messages_conv_key_id", "conversation_key", "id"),
+        db.Index("uq_messages_sender_client_msg", "sender_id", "client_msg_id", unique=True),
     )
 
 class PushSubscription(db.Model):
@@ -387,6 +892,34 @@ class PushSubscription(db.Model):
     __table_args__ = (db.UniqueConstraint('user_id', 'endpoint', name='uq_push_user_endpoint'),)
 
 
+class PushJob(db.Model):
+    """One queued Web Push notification (all of a user's devices), drained by the push workers."""
+    __tablename__ = "push_jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    status = db.Column(db.String(16), nullable=False, default="pending")  # pending|sending|done|failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    latency_ms = db.Column(db.Integer, nullable=True)  # enqueue -> final outcome
+    last_error = db.Column(db.String(255), nullable=True)
+    # Coalescing: one job per (user, conversation) window, counting the messages folded in
+    coalesce_key = db.Column(db.String(64), nullable=True)  # e.g. group-12 / dm-7; also the tag/Topic
+    coalesce_label = db.Column(db.String(120), nullable=True)  # "N new messages from <label>"
+    message_count = db.Column(db.Integer, nullable=False, default=1)
+    # JSON list of subscription ids still to deliver after a partial failure (NULL = all devices)
+    retry_subscription_ids = db.Column(db.Text, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_push_jobs_status_next", "status", "next_attempt_at"),
+        db.Index("ix_push_jobs_coalesce", "coalesce_key", "user_id", "created_at"),
+    )
+
+
 class MessageReaction(db.Model):
     __tablename__ = "message_reactions"
 
@@ -455,6 +988,170 @@ def is_conversation_muted(user_id: int, conv_type: str, conv_id: int) -> bool:
         return False
     return False
 
+class ConversationSummary(db.Model):
+    """Per-user sidebar row: last message, preview and unread count of one conversation.
+
+    Maintained on every message insert (see _track_conversation_summaries) and by the
+    read/edit/delete paths, so the sidebar and badges never aggregate message tables.
+    """
+    __tablename__ = "conversation_summary"
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    conversation_type = db.Column(db.String(16), nullable=False)  # dm|group
+    conversation_id = db.Column(db.Integer, nullable=False)  # other_user_id or group_id
+    last_message_id = db.Column(db.Integer, nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    last_preview = db.Column(db.String(SUMMARY_PREVIEW_LEN), nullable=True)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "conversation_type", "conversation_id", name="uq_conv_summary"),
+        db.Index("ix_conv_summary_user_last_id", "user_id", "last_message_at", "id"),
+        db.Index("ix_conv_summary_conv", "conversation_type", "conversation_id"),
+    )
+
+
+def _message_preview(msg) -> str:
+    if bool(getattr(msg, "deleted_for_all", False)):
+        return "تم حذف هذه الرسالة"
+    mtype = getattr(msg, "message_type", None) or "text"
+    if mtype == "image":
+        return "🖼️ صورة"
+    if mtype == "audio":
+        return "🎤 رسالة صوتية"
+    if mtype == "file":
+        return f"📎 {msg.content or 'ملف'}"[:SUMMARY_PREVIEW_LEN]
+    return (msg.content or "")[:SUMMARY_PREVIEW_LEN]
+
+
+def _insert_ignoring_conflicts(conn, table):
+    """INSERT that skips rows hitting a unique constraint (SQLite/Postgres ON CONFLICT DO NOTHING)."""
+    if conn.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif conn.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        return table.insert()
+    return dialect_insert(table).on_conflict_do_nothing()
+
+
+def _summary_apply_message(conn, msg, conv_type: str, where, unread_user_filter):
+    """Point matching summary rows at msg (if newer) and bump unread for recipients."""
+    t = ConversationSummary.__table__
+    newer = func.coalesce(t.c.last_message_id, 0) < int(msg.id)
+    conn.execute(
+        t.update()
+        .where(t.c.conversation_type == conv_type, where)
+        .values(
+            last_message_id=case((newer, int(msg.id)), else_=t.c.last_message_id),
+            last_message_at=case((newer, msg.timestamp), else_=t.c.last_message_at),
+            last_preview=case((newer, _message_preview(msg)), else_=t.c.last_preview),
+            unread_count=t.c.unread_count + case((unread_user_filter, 1), else_=0),
+        )
+    )
+
+
+def _summary_on_dm(conn, msg):
+    t = ConversationSummary.__table__
+    sid, rid = int(msg.sender_id), int(msg.receiver_id)
+    rows = [{"user_id": sid, "conversation_type": "dm", "conversation_id": rid, "unread_count": 0}]
+    if rid != sid:
+        rows.append({"user_id": rid, "conversation_type": "dm", "conversation_id": sid, "unread_count": 0})
+    conn.execute(_insert_ignoring_conflicts(conn, t).values(rows))
+    _summary_apply_message(
+        conn, msg, "dm",
+        or_(and_(t.c.user_id == sid, t.c.conversation_id == rid), and_(t.c.user_id == rid, t.c.conversation_id == sid)),
+        and_(t.c.user_id == rid, t.c.user_id != sid),
+    )
+
+
+def _summary_on_group(conn, msg):
+    t = ConversationSummary.__table__
+    gm = GroupMember.__table__
+    gid = int(msg.group_id)
+    missing = (
+        db.select(gm.c.user_id, db.literal("group"), db.literal(gid), db.literal(0))
+        .where(gm.c.group_id == gid, gm.c.status == "accepted")
+        .where(
+            ~db.select(t.c.id)
+            .where(t.c.user_id == gm.c.user_id, t.c.conversation_type == "group", t.c.conversation_id == gid)
+            .exists()
+        )
+    )
+    conn.execute(
+        _insert_ignoring_conflicts(conn, t).from_select(
+            ["user_id", "conversation_type", "conversation_id", "unread_count"], missing
+        )
+    )
+    _summary_apply_message(conn, msg, "group", t.c.conversation_id == gid, t.c.user_id != int(msg.sender_id))
+
+
+@db.event.listens_for(db.session, "after_flush")
+def _track_conversation_summaries(session, flush_context):
+    """Keep conversation_summary in step with every message insert, in the same transaction."""
+    new_msgs = [o for o in session.new if isinstance(o, (Message, GroupMessage))]
+    if not new_msgs:
+        return
+    conn = session.connection()
+    for msg in sorted(new_msgs, key=lambda o: int(o.id)):
+        if isinstance(msg, Message):
+            _summary_on_dm(conn, msg)
+        else:
+            _summary_on_group(conn, msg)
+
+
+def _summary_set_unread(user_id: int, conv_type: str, conv_id: int, unread):
+    """Set the unread count of one summary row (an int or a scalar SQL expression)."""
+    t = ConversationSummary.__table__
+    db.session.execute(
+        t.update()
+        .where(t.c.user_id == int(user_id), t.c.conversation_type == conv_type, t.c.conversation_id == int(conv_id))
+        .values(unread_count=unread)
+    )
+
+
+def _summary_drop_unread(user_id: int, conv_type: str, conv_id: int) -> int:
+    """Take one unread message off a summary row (an unread message was hidden); returns the new count."""
+    t = ConversationSummary.__table__
+    where = (t.c.user_id == int(user_id), t.c.conversation_type == conv_type, t.c.conversation_id == int(conv_id))
+    db.session.execute(
+        t.update().where(*where).values(unread_count=case((t.c.unread_count > 0, t.c.unread_count - 1), else_=0))
+    )
+    return int(db.session.execute(db.select(t.c.unread_count).where(*where)).scalar() or 0)
+
+
+def _summary_set_preview(conv_type: str, message_id: int, preview: str):
+    """Refresh the preview of every summary row whose last message is message_id (edit / delete for all)."""
+    t = ConversationSummary.__table__
+    db.session.execute(
+        t.update()
+        .where(t.c.conversation_type == conv_type, t.c.last_message_id == int(message_id))
+        .values(last_preview=preview[:SUMMARY_PREVIEW_LEN])
+    )
+
+
+def _summary_refresh_last(user_id: int, conv_type: str, conv_id: int):
+    """Re-point one user's summary row at the newest message they can still see (delete for me)."""
+    if conv_type == "dm":
+        q = Message.query.filter(Message.conversation_key == _dm_conversation_key(user_id, conv_id))
+        model = Message
+    else:
+        q = GroupMessage.query.filter(GroupMessage.group_id == int(conv_id))
+        model = GroupMessage
+    last = q.filter(_not_hidden_for(user_id, conv_type, model.id)).order_by(model.id.desc()).first()
+    t = ConversationSummary.__table__
+    db.session.execute(
+        t.update()
+        .where(t.c.user_id == int(user_id), t.c.conversation_type == conv_type, t.c.conversation_id == int(conv_id))
+        .values(
+            last_message_id=(int(last.id) if last else None),
+            last_message_at=(last.timestamp if last else None),
+            last_preview=(_message_preview(last) if last else None),
+        )
+    )
+
+
 class StarredMessage(db.Model):
     __tablename__ = "starred_messages"
 
@@ -484,6 +1181,11 @@ class GroupInviteLink(db.Model):
 
 
 class GroupMessageReceipt(db.Model):
+    """Legacy per-message receipts.
+
+    Superseded by the GroupMember read/delivered watermarks; rows are only read once
+    by _migrate_group_receipts_to_watermarks().
+    """
     __tablename__ = "group_message_receipts"
 
     id = db.Column(db.Integer, primary_key=True)
@@ -507,6 +1209,45 @@ class GroupMessageMention(db.Model):
     )
 
 
+class MediaBlob(db.Model):
+    """One stored upload per (category, SHA-256 digest), shared by every message that sends it."""
+    __tablename__ = "media_blobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    category = db.Column(db.String(16), nullable=False)  # images|audio|files
+    digest = db.Column(db.String(64), nullable=False)
+    filename = db.Column(db.String(100), nullable=False)  # "<digest><ext>" inside the category folder
+    size = db.Column(db.Integer, nullable=False, default=0)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # messages whose media_url points here
+    # Image derivatives (filenames in the same folder) and original dimensions
+    thumb_filename = db.Column(db.String(120), nullable=True)
+    preview_filename = db.Column(db.String(120), nullable=True)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+
+    __table_args__ = (
+        db.UniqueConstraint("category", "digest", name="uq_media_blobs_category_digest"),
+    )
+
+
+class MediaObject(db.Model):
+    """Which conversations a stored media file was sent in; serve_media authorizes from here.
+
+    Keyed by (category, filename) first, so a media request is one primary-key range read
+    instead of a scan of the unindexed messages.media_url / group_messages.media_url.
+    """
+    __tablename__ = "media_objects"
+
+    category = db.Column(db.String(16), primary_key=True)
+    filename = db.Column(db.String(100), primary_key=True)
+    conversation_type = db.Column(db.String(16), primary_key=True)  # dm|group
+    conversation_ref = db.Column(db.String(32), primary_key=True)  # DM conversation_key or group id
+    size = db.Column(db.Integer, nullable=True)
+    mime = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+
+
 # ----------------- Socket.IO Events -----------------
 @socketio.on("connect")
 def handle_socket_connect():
@@ -554,6 +1295,24 @@ def handle_socket_connect():
     except Exception:
         db.session.rollback()
 
+    # Group messages: everything up to now has been delivered to this user
+    try:
+        gm = GroupMember.__table__
+        latest = (
+            db.select(func.max(GroupMessage.id))
+            .where(GroupMessage.group_id == gm.c.group_id)
+            .scalar_subquery()
+        )
+        db.session.execute(
+            gm.update()
+            .where(gm.c.user_id == user_id, gm.c.status == "accepted")
+            .where(func.coalesce(gm.c.last_delivered_message_id, 0) < latest)
+            .values(last_delivered_message_id=latest)
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+
     # (delivery marking handled above)
 
 
@@ -614,6 +1373,32 @@ def handle_typing(data):
         socketio.emit("typing", payload, room=f"user_{rid_int}", include_self=False)
 
 
+@socketio.on("send_message")
+def handle_send_message(data):
+    """Send a text message over the open socket instead of an HTTP round trip.
+
+    The ack mirrors the /send_message or /send_group_message response body plus
+    status_code and the client's client_id, so the sender can settle its pending bubble.
+    """
+    if not isinstance(data, dict):
+        return {"ok": False, "error": "bad_request", "status_code": 400}
+    client_id = data.get("client_id")
+    user_id = session.get("user_id")
+    if not user_id:
+        return {"ok": False, "error": "unauthorized", "status_code": 401, "client_id": client_id}
+
+    client_msg_id = data.get("client_msg_id") or client_id
+    if data.get("group_id") not in (None, ""):
+        body, status = _send_group_text(
+            user_id, data.get("group_id"), data.get("content"), data.get("reply_to_id"), client_msg_id
+        )
+    else:
+        body, status = _send_direct_text(
+            user_id, data.get("receiver_id"), data.get("content"), data.get("reply_to_id"), client_msg_id
+        )
+    return {**body, "status_code": status, "client_id": client_id}
+
+
 # ----------------- Routes -----------------
 
 # ----------------- Web Push Helpers -----------------
@@ -628,7 +1413,28 @@ def _instance_vapid_path() -> str:
     return os.path.join(app.instance_path, "vapid_keys.json")
 
 
+_vapid_keys = None
+_vapid_signer = None
+_vapid_header_cache = {}  # push-service origin -> (expires_at, headers)
+_vapid_lock = threading.Lock()
+VAPID_JWT_TTL_SECONDS = 12 * 3600
+VAPID_JWT_REFRESH_SECONDS = 600  # re-sign this long before exp
+
+
 def ensure_vapid_keys() -> tuple[str, str]:
+    """Return (public, private) VAPID keys, loaded once per process (see _load_vapid_keys)."""
+    global _vapid_keys
+    if _vapid_keys is None:
+        with _vapid_lock:
+            if _vapid_keys is None:
+                keys = _load_vapid_keys()
+                if not (keys[0] and keys[1]):
+                    return keys  # don't cache a failure; retry on the next call
+                _vapid_keys = keys
+    return _vapid_keys
+
+
+def _load_vapid_keys() -> tuple[str, str]:
     """Return (public, private) VAPID keys.
 
     Priority:
@@ -692,66 +1498,443 @@ def get_vapid_private_key():
     _, priv = ensure_vapid_keys()
     return (priv or "").strip()
 
-def send_push_to_user_detail(user_id: int, payload: dict):
+
+def _vapid_headers(endpoint: str, priv: str) -> dict:
+    """Signed VAPID Authorization header for the endpoint's push service.
+
+    The ES256 JWT only depends on the origin (aud), so it is cached per origin and
+    re-signed shortly before it expires instead of once per notification.
+    """
+    global _vapid_signer
+    url = urlparse(endpoint)
+    aud = f"{url.scheme}://{url.netloc}"
+    now = int(time.time())
+    cached = _vapid_header_cache.get(aud)
+    if cached and cached[0] - VAPID_JWT_REFRESH_SECONDS > now:
+        return cached[1]
+    with _vapid_lock:
+        cached = _vapid_header_cache.get(aud)
+        if cached and cached[0] - VAPID_JWT_REFRESH_SECONDS > now:
+            return cached[1]
+        if _vapid_signer is None:
+            _vapid_signer = Vapid.from_string(private_key=priv)
+        exp = now + VAPID_JWT_TTL_SECONDS
+        headers = _vapid_signer.sign({
+            "aud": aud,
+            "exp": exp,
+            "sub": os.getenv("VAPID_CLAIMS_SUB", "mailto:admin@example.com"),
+        })
+        _vapid_header_cache[aud] = (exp, headers)
+        return headers
+
+
+_push_sessions = {}  # push-service origin -> requests.Session
+_push_sessions_lock = threading.Lock()
+
+
+def _push_session(endpoint: str):
+    """Keep-alive session for the endpoint's push service, so sends reuse TLS connections."""
+    url = urlparse(endpoint)
+    origin = f"{url.scheme}://{url.netloc}"
+    sess = _push_sessions.get(origin)
+    if sess is None:
+        with _push_sessions_lock:
+            sess = _push_sessions.get(origin)
+            if sess is None:
+                sess = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PUSH_HTTP_POOL_SIZE)
+                sess.mount("https://", adapter)
+                sess.mount("http://", adapter)
+                _push_sessions[origin] = sess
+    return sess
+
+
+def push_http_stats() -> dict:
+    """Per-origin connection counters: requests sent, connections opened, and reuses."""
+    out = {}
+    for origin, sess in list(_push_sessions.items()):
+        requests_sent = connections = 0
+        for adapter in {id(a): a for a in sess.adapters.values()}.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    requests_sent += pool.num_requests
+                    connections += pool.num_connections
+        out[origin] = {"requests": requests_sent, "connections": connections, "reused": max(requests_sent - connections, 0)}
+    return out
+
+
+def _classify_push_error(exc) -> tuple:
+    """Map a failed send to (outcome, status_code).
+
+    outcome: "gone" (404/410: the subscription is dead, prune it), "retry" (429, 5xx,
+    network errors) or "rejected" (other 4xx: retrying the same request won't help).
+    """
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    if status in (404, 410):
+        return "gone", status
+    if status is None or status == 429 or status >= 500:
+        return "retry", status
+    return "rejected", status
+
+
+_push_endpoint_stats = {}  # push-service origin -> counters, see push_endpoint_stats()
+_push_stats_lock = threading.Lock()
+
+
+def _record_push_outcome(endpoint: str, outcome: str, status=None):
+    url = urlparse(endpoint)
+    origin = f"{url.scheme}://{url.netloc}"
+    with _push_stats_lock:
+        st = _push_endpoint_stats.setdefault(origin, {"ok": 0, "gone": 0, "retry": 0, "rejected": 0})
+        st[outcome] += 1
+        if outcome != "ok":
+            st["last_failure_status"] = status
+            st["last_failure_at"] = _utc_iso(datetime.now(timezone.utc).replace(tzinfo=None))
+
+
+def push_endpoint_stats() -> dict:
+    """Per push-service origin: sends by outcome (ok/gone/retry/rejected) and the last failure."""
+    with _push_stats_lock:
+        return {origin: dict(st) for origin, st in _push_endpoint_stats.items()}
+
+
+_push_device_pool = None
+
+
+def _push_device_executor():
+    """Process-wide pool that bounds concurrent device sends across all push jobs."""
+    global _push_device_pool
+    if _push_device_pool is None:
+        with _push_lock:
+            if _push_device_pool is None:
+                _push_device_pool = ThreadPoolExecutor(max_workers=PUSH_DEVICE_WORKERS, thread_name_prefix="push-device")
+    return _push_device_pool
+
+
+def _send_push_to_device(sub: dict, data: str, headers: dict, priv: str) -> dict:
+    """Encrypt and send to one subscription (plain dict, safe off the request thread)."""
+    try:
+        webpush(
+            subscription_info={"endpoint": sub["endpoint"], "keys": sub["keys"]},
+            data=data,
+            headers={**headers, **_vapid_headers(sub["endpoint"], priv)},
+            ttl=PUSH_TTL_SECONDS,
+            requests_session=_push_session(sub["endpoint"]),
+            timeout=(PUSH_HTTP_CONNECT_TIMEOUT, PUSH_HTTP_READ_TIMEOUT),
+        )
+        outcome, status = "ok", None
+    except WebPushException as e:
+        outcome, status = _classify_push_error(e)
+    except Exception:
+        outcome, status = "retry", None
+    _record_push_outcome(sub["endpoint"], outcome, status)
+    return {"subscription_id": sub["id"], "outcome": outcome, "status": status}
+
+
+def send_push_to_user_detail(user_id: int, payload: dict, headers: dict = None, urgency: str = "high",
+                             subscription_ids=None) -> dict:
     """Send Web Push notification to all active subscriptions for a user.
 
-    Returns: (ok: bool, reason: str)
+    Devices are encrypted and sent concurrently on the shared device pool. Sends carry
+    TTL (PUSH_TTL_SECONDS) and Urgency headers so push services can drop stale
+    notifications. Subscriptions answered with 404/410 are deactivated in one batched
+    commit; 429/5xx/network failures are left for the push queue to retry.
+    subscription_ids restricts the send to those devices (a retry).
+
+    Returns: {"ok": bool, "reason": str, "devices": [{"subscription_id", "outcome", "status"}]}
+      outcome per device: ok | gone | retry | rejected
       reason can be:
         - missing_pywebpush
         - missing_vapid
         - no_subscription
-        - send_failed
+        - retry     (some device failed transiently)
+        - gone      (every device was pruned)
+        - rejected  (permanent failures, e.g. 400/403/413)
         - ok
     """
     if not webpush:
-        return False, "missing_pywebpush"
+        return {"ok": False, "reason": "missing_pywebpush", "devices": []}
 
     pub = get_vapid_public_key()
     priv = get_vapid_private_key()
     if not pub or not priv:
-        return False, "missing_vapid"
-
-    subs = PushSubscription.query.filter_by(user_id=user_id, is_active=True).all()
+        return {"ok": False, "reason": "missing_vapid", "devices": []}
+
+    q = PushSubscription.query.filter_by(user_id=user_id, is_active=True)
+    if subscription_ids is not None:
+        q = q.filter(PushSubscription.id.in_([int(i) for i in subscription_ids] or [-1]))
+    subs = [
+        {"id": int(s.id), "endpoint": s.endpoint, "keys": {"p256dh": s.p256dh, "auth": s.auth}}
+        for s in q.all()
+    ]
     if not subs:
-        return False, "no_subscription"
+        return {"ok": False, "reason": "no_subscription", "devices": []}
 
-    vapid_claims = {"sub": os.getenv("VAPID_CLAIMS_SUB", "mailto:admin@example.com")}
-    ok_any = False
-    failed_any = False
+    data = json.dumps(payload)
+    send_headers = {**(headers or {}), "Urgency": urgency}
+    if len(subs) == 1:
+        devices = [_send_push_to_device(subs[0], data, send_headers, priv)]
+    else:
+        pool = _push_device_executor()
+        futures = [pool.submit(_send_push_to_device, sub, data, send_headers, priv) for sub in subs]
+        devices = [f.result() for f in futures]
 
-    for s in subs:
+    dead_ids = [d["subscription_id"] for d in devices if d["outcome"] == "gone"]
+    if dead_ids:
         try:
-            subscription_info = {
-                "endpoint": s.endpoint,
-                "keys": {"p256dh": s.p256dh, "auth": s.auth}
-            }
-            webpush(
-                subscription_info=subscription_info,
-                data=json.dumps(payload),
-                vapid_private_key=priv,
-                vapid_claims=vapid_claims
+            PushSubscription.query.filter(PushSubscription.id.in_(dead_ids)).update(
+                {"is_active": False}, synchronize_session=False
             )
-            ok_any = True
-        except WebPushException:
-            failed_any = True
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+
+    outcomes = [d["outcome"] for d in devices]
+    if "retry" in outcomes:
+        reason = "retry"
+    elif "ok" in outcomes:
+        reason = "ok"
+    elif all(o == "gone" for o in outcomes):
+        reason = "gone"
+    else:
+        reason = "rejected"
+    return {"ok": "ok" in outcomes, "reason": reason, "devices": devices}
+
+
+# Reasons from send_push_to_user_detail that a retry cannot fix
+_PUSH_FINAL_REASONS = {"ok", "missing_pywebpush", "missing_vapid", "no_subscription", "gone", "rejected"}
+
+_push_queue = queue.Queue()
+_push_pool = None
+_push_dispatcher = None
+_push_lock = threading.Lock()
+
+
+def enqueue_pushes(user_ids, payload: dict, coalesce_key: str = None, coalesce_label: str = None):
+    """Persist one push job per user (a single commit) and hand them to the worker pool.
+
+    The request never waits on push services. With a coalesce_key, a user's still-pending
+    job for the same conversation absorbs the message (its count goes up), and a user
+    pushed within the last PUSH_COALESCE_SECONDS gets the next push at the end of that
+    window; the worker then sends one "N new messages" notification.
+    """
+    user_ids = sorted({int(u) for u in user_ids})
+    if not user_ids:
+        return []
+    data = json.dumps(payload, ensure_ascii=False)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    t = PushJob.__table__
+    due = {uid: now for uid in user_ids}
+    job_ids = []
+
+    if coalesce_key:
+        window = timedelta(seconds=PUSH_COALESCE_SECONDS)
+        latest = {}
+        for row in db.session.execute(
+            db.select(t.c.id, t.c.user_id, t.c.status, t.c.next_attempt_at)
+            .where(t.c.coalesce_key == coalesce_key, t.c.user_id.in_(user_ids), t.c.created_at >= now - window)
+            .order_by(t.c.id)
+        ):
+            latest[int(row.user_id)] = row
+        fold_ids = [int(r.id) for r in latest.values() if r.status == "pending"]
+        if fold_ids:
+            # A folded job carries a new message for every device, not just the ones a
+            # partial failure left to retry
+            fold_values = {"message_count": t.c.message_count + 1, "payload": data, "retry_subscription_ids": None}
+            if db.session.get_bind().dialect.update_returning:
+                folded = set(db.session.execute(
+                    t.update()
+                    .where(t.c.id.in_(fold_ids), t.c.status == "pending")
+                    .values(**fold_values)
+                    .returning(t.c.user_id)
+                ).scalars())
+            else:
+                # No RETURNING: a row counts as folded only if it was still pending
+                folded = set()
+                for row in latest.values():
+                    if row.status != "pending":
+                        continue
+                    res = db.session.execute(
+                        t.update().where(t.c.id == row.id, t.c.status == "pending").values(**fold_values)
+                    )
+                    if res.rowcount:
+                        folded.add(int(row.user_id))
+            for uid in folded:
+                due.pop(int(uid), None)
+        for uid, row in latest.items():
+            if uid in due and row.next_attempt_at:
+                due[uid] = max(now, row.next_attempt_at + window)
+
+    if due:
+        job_ids = list(db.session.execute(
+            t.insert().returning(t.c.id, t.c.next_attempt_at),
+            [{
+                "user_id": uid, "payload": data, "status": "pending", "attempts": 0,
+                "next_attempt_at": when, "created_at": now, "message_count": 1,
+                "coalesce_key": coalesce_key, "coalesce_label": (coalesce_label or "")[:120] or None,
+            } for uid, when in due.items()],
+        ).all())
+    db.session.commit()
+    _ensure_push_dispatcher()
+    for job_id, when in job_ids:
+        _push_queue.put((when, int(job_id)))
+    return [int(job_id) for job_id, _ in job_ids]
+
+
+def _push_target_filter(user_col, conv_type: str, conv_id):
+    """Users with an active subscription who have not muted the conversation."""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    has_subscription = (
+        db.select(PushSubscription.id)
+        .where(PushSubscription.user_id == user_col, PushSubscription.is_active == True)  # noqa: E712
+        .exists()
+    )
+    muted = (
+        db.select(ConversationSetting.id)
+        .where(
+            ConversationSetting.user_id == user_col,
+            ConversationSetting.conversation_type == conv_type,
+            ConversationSetting.conversation_id == int(conv_id),
+            ConversationSetting.muted_until > now,
+        )
+        .exists()
+    )
+    return and_(has_subscription, ~muted)
+
+
+def _group_push_recipients(group_id: int, sender_id: int) -> list:
+    """Accepted members (except the sender) to push a group message to, in one query."""
+    return list(db.session.execute(
+        db.select(GroupMember.user_id).where(
+            GroupMember.group_id == int(group_id),
+            GroupMember.status == "accepted",
+            GroupMember.user_id != int(sender_id),
+            _push_target_filter(GroupMember.user_id, "group", group_id),
+        )
+    ).scalars())
+
+
+def _group_push_label(group_id: int) -> str:
+    g = db.session.get(Group, int(group_id))
+    return f"مجموعة {g.name}" if g else "مجموعة"
+
+
+def _dm_push_recipients(receiver_id: int, sender_id: int) -> list:
+    return list(db.session.execute(
+        db.select(User.id).where(User.id == int(receiver_id), _push_target_filter(User.id, "dm", sender_id))
+    ).scalars())
+
+
+def _ensure_push_dispatcher():
+    global _push_pool, _push_dispatcher
+    if _push_dispatcher is not None:
+        return
+    with _push_lock:
+        if _push_dispatcher is not None:
+            return
+        _push_pool = ThreadPoolExecutor(max_workers=PUSH_WORKERS, thread_name_prefix="push")
+        _push_dispatcher = threading.Thread(target=_push_dispatch_loop, name="push-dispatcher", daemon=True)
+        _push_dispatcher.start()
+
+
+def _push_dispatch_loop():
+    """Feed job ids to the pool: queued ones when due, retries and leftovers from the table."""
+    last_scan = 0.0
+    delayed = []  # heap of (due_at, job_id) for coalescing windows
+    while True:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        while delayed and delayed[0][0] <= now:
+            _push_pool.submit(_run_push_job, heapq.heappop(delayed)[1])
+        # Wake up for the next delayed job or the next table scan, whichever comes first
+        wait = max(PUSH_POLL_SECONDS - (time.monotonic() - last_scan), 0.01)
+        if delayed:
+            wait = min(wait, max((delayed[0][0] - now).total_seconds(), 0.01))
+        try:
+            due_at, job_id = _push_queue.get(timeout=wait)
+            heapq.heappush(delayed, (due_at, job_id))
+        except queue.Empty:
+            pass
+        # Scanned on every pass, so steady traffic can't starve retries and stale jobs
+        if time.monotonic() - last_scan >= PUSH_POLL_SECONDS:
+            last_scan = time.monotonic()
             try:
-                s.is_active = False
-                db.session.commit()
+                for due_id in _due_push_job_ids():
+                    _push_pool.submit(_run_push_job, due_id)
             except Exception:
-                db.session.rollback()
-        except Exception:
-            failed_any = True
+                app.logger.exception("Push dispatcher scan failed")
+
+
+def _due_push_job_ids(limit: int = 200):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    t = PushJob.__table__
+    with app.app_context():
+        # Jobs claimed by a worker that died (e.g. a restart mid-send) go back to pending
+        db.session.execute(
+            t.update()
+            .where(t.c.status == "sending", t.c.claimed_at < now - timedelta(seconds=PUSH_STALE_SECONDS))
+            .values(status="pending")
+        )
+        db.session.commit()
+        return [
+            int(jid) for (jid,) in db.session.execute(
+                db.select(t.c.id)
+                .where(t.c.status == "pending", t.c.next_attempt_at <= now)
+                .order_by(t.c.id)
+                .limit(limit)
+            )
+        ]
 
-    if ok_any:
-        return True, "ok"
-    if failed_any:
-        return False, "send_failed"
-    return False, "send_failed"
 
+def _run_push_job(job_id: int):
+    t = PushJob.__table__
+    with app.app_context():
+        try:
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            # Claim: only one worker (or process) sends a given job
+            claimed = db.session.execute(
+                t.update()
+                .where(t.c.id == int(job_id), t.c.status == "pending")
+                .values(status="sending", claimed_at=now, attempts=t.c.attempts + 1)
+            ).rowcount
+            db.session.commit()
+            if not claimed:
+                return
+            job = db.session.get(PushJob, int(job_id))
+            payload = json.loads(job.payload)
+            headers = None
+            if job.coalesce_key:
+                # Stable tag/Topic: the device and the push service replace rather than stack
+                payload["tag"] = job.coalesce_key
+                headers = {"Topic": job.coalesce_key}
+                if int(job.message_count or 1) > 1:
+                    payload["body"] = f"{int(job.message_count)} رسائل جديدة من {job.coalesce_label or 'مستخدم'}"
+            retry_ids = json.loads(job.retry_subscription_ids) if job.retry_subscription_ids else None
+            try:
+                result = send_push_to_user_detail(job.user_id, payload, headers=headers, subscription_ids=retry_ids)
+                delivered, reason = result["ok"], result["reason"]
+                # Next attempt only goes to the devices that failed transiently
+                retry_ids = [d["subscription_id"] for d in result["devices"] if d["outcome"] == "retry"] or retry_ids
+            except Exception as e:
+                delivered, reason = False, f"error: {e}"[:255]
 
-def send_push_to_user(user_id: int, payload: dict) -> bool:
-    ok, _reason = send_push_to_user_detail(user_id, payload)
-    return bool(ok)
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            if reason in _PUSH_FINAL_REASONS or job.attempts >= PUSH_MAX_ATTEMPTS:
+                job.status = "done" if reason == "ok" else "failed"
+                job.finished_at = now
+                job.latency_ms = int((now - job.created_at).total_seconds() * 1000)
+                job.last_error = None if reason == "ok" else reason
+            else:
+                job.status = "pending"
+                job.last_error = f"{reason} (partly delivered)" if delivered else reason
+                job.retry_subscription_ids = json.dumps(retry_ids) if retry_ids else None
+                job.next_attempt_at = now + timedelta(seconds=PUSH_RETRY_BASE_SECONDS * (2 ** (job.attempts - 1)))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Push job %s failed", job_id)
 
 
 @app.route("/api/push/vapid_public_key", methods=["GET"])
@@ -832,10 +2015,18 @@ def api_push_test():
         "tag": "chat-push-test"
     }
 
-    ok, reason = send_push_to_user_detail(me.id, payload)
-    if not ok:
-        return jsonify({"ok": False, "error": reason}), 400
-    return jsonify({"ok": True}), 200
+    result = send_push_to_user_detail(me.id, payload, urgency="normal")
+    if not result["ok"]:
+        return jsonify({"ok": False, "error": result["reason"], "devices": result["devices"]}), 400
+    return jsonify({"ok": True, "devices": result["devices"]}), 200
+
+@app.route("/api/push/stats", methods=["GET"])
+def api_push_stats():
+    """Push delivery health: outcomes and connection reuse per push-service origin."""
+    if not login_required():
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    return jsonify({"ok": True, "endpoints": push_endpoint_stats(), "connections": push_http_stats()})
+
 
 # ----------------- PWA / Service Worker -----------------
 # IMPORTANT:
@@ -890,6 +2081,9 @@ class GroupMember(db.Model):
     invited_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None), index=True)
     responded_at = db.Column(db.DateTime, nullable=True)
     last_read_at = db.Column(db.DateTime, nullable=True, index=True)
+    # Read/delivered watermarks: every group message with id <= watermark counts as read/delivered
+    last_read_message_id = db.Column(db.Integer, nullable=True)
+    last_delivered_message_id = db.Column(db.Integer, nullable=True)
 
     group = db.relationship("Group", foreign_keys=[group_id])
     user = db.relationship("User", foreign_keys=[user_id])
@@ -921,12 +2115,18 @@ class GroupMessage(db.Model):
     reply_to_id = db.Column(db.Integer, nullable=True, index=True)
     message_kind = db.Column(db.String(20), default="user", index=True)  # user / system
     system_payload = db.Column(db.Text, nullable=True)
+    client_msg_id = db.Column(db.String(64), nullable=True)
+    thumb_url = db.Column(db.Text, nullable=True)
+    preview_url = db.Column(db.Text, nullable=True)
+    media_width = db.Column(db.Integer, nullable=True)
+    media_height = db.Column(db.Integer, nullable=True)
 
     group = db.relationship("Group", foreign_keys=[group_id])
     sender = db.relationship("User", foreign_keys=[sender_id])
 
     __table_args__ = (
         db.Index("ix_group_messages_group_ts", "group_id", "timestamp"),
+        db.Index("uq_group_messages_sender_client_msg", "sender_id", "client_msg_id", unique=True),
     )
 
 
@@ -989,19 +2189,46 @@ def _ensure_schema_once():
         ("deleted_for_all", "BOOLEAN DEFAULT 0"),
         ("reply_to_id", "INTEGER"),
         ("forwarded", "BOOLEAN DEFAULT 0"),
+        ("conversation_key", "VARCHAR(32)"),
+        ("client_msg_id", "VARCHAR(64)"),
+        ("thumb_url", "TEXT"),
+        ("preview_url", "TEXT"),
+        ("media_width", "INTEGER"),
+        ("media_height", "INTEGER"),
     ]
 
     # SQLite vs Postgres declarations
     if _db_is_sqlite():
         _ensure_columns_sqlite("messages", msg_cols)
         # Group members role + group message extras
-        _ensure_columns_sqlite("group_members", [("role", "TEXT DEFAULT 'member'")])
+        _ensure_columns_sqlite("group_members", [
+            ("role", "TEXT DEFAULT 'member'"),
+            ("last_read_message_id", "INTEGER"),
+            ("last_delivered_message_id", "INTEGER"),
+        ])
+        _ensure_columns_sqlite("push_jobs", [
+            ("coalesce_key", "VARCHAR(64)"),
+            ("coalesce_label", "VARCHAR(120)"),
+            ("message_count", "INTEGER DEFAULT 1"),
+            ("retry_subscription_ids", "TEXT"),
+        ])
         _ensure_columns_sqlite("group_messages", [
             ("edited_at", "DATETIME"),
             ("deleted_for_all", "BOOLEAN DEFAULT 0"),
             ("reply_to_id", "INTEGER"),
             ("message_kind", "TEXT DEFAULT 'user'"),
             ("system_payload", "TEXT"),
+            ("client_msg_id", "VARCHAR(64)"),
+            ("thumb_url", "TEXT"),
+            ("preview_url", "TEXT"),
+            ("media_width", "INTEGER"),
+            ("media_height", "INTEGER"),
+        ])
+        _ensure_columns_sqlite("media_blobs", [
+            ("thumb_filename", "VARCHAR(120)"),
+            ("preview_filename", "VARCHAR(120)"),
+            ("width", "INTEGER"),
+            ("height", "INTEGER"),
         ])
     else:
         pg_cols = [
@@ -1011,16 +2238,272 @@ def _ensure_schema_once():
             ("deleted_for_all", "BOOLEAN DEFAULT FALSE"),
             ("reply_to_id", "INTEGER"),
             ("forwarded", "BOOLEAN DEFAULT FALSE"),
+            ("conversation_key", "VARCHAR(32)"),
+            ("client_msg_id", "VARCHAR(64)"),
+            ("thumb_url", "TEXT"),
+            ("preview_url", "TEXT"),
+            ("media_width", "INTEGER"),
+            ("media_height", "INTEGER"),
         ]
         _ensure_columns_postgres("messages", pg_cols)
-        _ensure_columns_postgres("group_members", [("role", "TEXT DEFAULT 'member'")])
+        _ensure_columns_postgres("group_members", [
+            ("role", "TEXT DEFAULT 'member'"),
+            ("last_read_message_id", "INTEGER"),
+            ("last_delivered_message_id", "INTEGER"),
+        ])
+        _ensure_columns_postgres("push_jobs", [
+            ("coalesce_key", "VARCHAR(64)"),
+            ("coalesce_label", "VARCHAR(120)"),
+            ("message_count", "INTEGER DEFAULT 1"),
+            ("retry_subscription_ids", "TEXT"),
+        ])
         _ensure_columns_postgres("group_messages", [
             ("edited_at", "TIMESTAMP"),
             ("deleted_for_all", "BOOLEAN DEFAULT FALSE"),
             ("reply_to_id", "INTEGER"),
             ("message_kind", "TEXT DEFAULT 'user'"),
             ("system_payload", "TEXT"),
+            ("client_msg_id", "VARCHAR(64)"),
+            ("thumb_url", "TEXT"),
+            ("preview_url", "TEXT"),
+            ("media_width", "INTEGER"),
+            ("media_height", "INTEGER"),
         ])
+        _ensure_columns_postgres("media_blobs", [
+            ("thumb_filename", "VARCHAR(120)"),
+            ("preview_filename", "VARCHAR(120)"),
+            ("width", "INTEGER"),
+            ("height", "INTEGER"),
+        ])
+
+    _migrate_group_receipts_to_watermarks()
+    _backfill_conversation_keys()
+    _backfill_conversation_summaries()
+    _backfill_media_objects()
+    try:
+        # create_all() does not add indexes to tables that already exist
+        for idx in PushJob.__table__.indexes:
+            idx.create(db.engine, checkfirst=True)
+    except Exception:
+        app.logger.exception("DB migration (push_jobs indexes) failed")
+    try:
+        for idx in (*Message.__table__.indexes, *GroupMessage.__table__.indexes):
+            if idx.name in ("uq_messages_sender_client_msg", "uq_group_messages_sender_client_msg"):
+                idx.create(db.engine, checkfirst=True)
+    except Exception:
+        app.logger.exception("DB migration (client_msg_id indexes) failed")
+    try:
+        # (user_id, last_message_at) is a prefix of the sidebar paging index
+        with db.engine.begin() as conn:
+            conn.execute(db.text("DROP INDEX IF EXISTS ix_conv_summary_user_last"))
+        for idx in ConversationSummary.__table__.indexes:
+            if idx.name == "ix_conv_summary_user_last_id":
+                idx.create(db.engine, checkfirst=True)
+    except Exception:
+        app.logger.exception("DB migration (conversation_summary index) failed")
+    # Resume push jobs persisted before a restart
+    _ensure_push_dispatcher()
+
+
+def _backfill_media_objects():
+    """Index media sent before media_objects existed, the first time the table is empty."""
+    try:
+        if db.session.query(MediaObject.filename).first() is not None:
+            return
+        rows = {}
+        dm_rows = db.session.execute(
+            db.select(Message.media_url, Message.sender_id, Message.receiver_id, Message.media_mime)
+            .where(Message.media_url.like("/media/%"))
+        )
+        for media_url, sender_id, receiver_id, mime in dm_rows:
+            key = _split_media_url(media_url)
+            if key:
+                rows.setdefault((*key, "dm", _dm_conversation_key(sender_id, receiver_id)), mime)
+        group_rows = db.session.execute(
+            db.select(GroupMessage.media_url, GroupMessage.group_id, GroupMessage.media_mime)
+            .where(GroupMessage.media_url.like("/media/%"))
+        )
+        for media_url, group_id, mime in group_rows:
+            key = _split_media_url(media_url)
+            if key:
+                rows.setdefault((*key, "group", str(int(group_id))), mime)
+        if not rows:
+            return
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        values = [
+            {"category": c, "filename": f, "conversation_type": t, "conversation_ref": r, "mime": m, "created_at": now}
+            for (c, f, t, r), m in rows.items()
+        ]
+        conn = db.session.connection()
+        table = MediaObject.__table__
+        for i in range(0, len(values), 500):
+            conn.execute(_insert_ignoring_conflicts(conn, table), values[i:i + 500])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("DB migration (media_objects backfill) failed")
+
+
+def _backfill_conversation_summaries():
+    """Build conversation_summary from the message tables the first time it is empty."""
+    if db.session.query(ConversationSummary.id).first() is not None:
+        return
+    m = Message.__table__
+    gm = GroupMember.__table__
+    gmsg = GroupMessage.__table__
+    try:
+        rows = {}
+        # DM: newest message per (user, other) pair, seen from both sides
+        sides = db.union_all(
+            db.select(m.c.sender_id.label("uid"), m.c.receiver_id.label("other"), m.c.id),
+            db.select(m.c.receiver_id.label("uid"), m.c.sender_id.label("other"), m.c.id),
+        ).subquery()
+        vis = MessageVisibility.__table__
+        hidden = (
+            db.select(vis.c.id)
+            .where(
+                vis.c.message_type == "dm",
+                vis.c.message_id == sides.c.id,
+                vis.c.user_id == sides.c.uid,
+                vis.c.is_deleted_for_me == True,  # noqa: E712
+            )
+            .exists()
+        )
+        for uid, other, last_id in db.session.execute(
+            db.select(sides.c.uid, sides.c.other, func.max(sides.c.id))
+            .where(~hidden)
+            .group_by(sides.c.uid, sides.c.other)
+        ):
+            rows[(int(uid), "dm", int(other))] = {"last_message_id": int(last_id), "unread_count": 0}
+        for uid, other, cnt in db.session.execute(
+            db.select(m.c.receiver_id, m.c.sender_id, func.count(m.c.id))
+            .where(m.c.is_read == False, m.c.sender_id != m.c.receiver_id)  # noqa: E712
+            .group_by(m.c.receiver_id, m.c.sender_id)
+        ):
+            if (int(uid), "dm", int(other)) in rows:
+                rows[(int(uid), "dm", int(other))]["unread_count"] = int(cnt)
+
+        # Groups: one row per accepted member, unread = messages past the read watermark
+        group_last = dict(
+            db.session.execute(db.select(gmsg.c.group_id, func.max(gmsg.c.id)).group_by(gmsg.c.group_id)).all()
+        )
+        for uid, gid in db.session.execute(db.select(gm.c.user_id, gm.c.group_id).where(gm.c.status == "accepted")):
+            last_id = group_last.get(gid)
+            rows[(int(uid), "group", int(gid))] = {
+                "last_message_id": int(last_id) if last_id else None,
+                "unread_count": 0,
+            }
+        for uid, gid, cnt in db.session.execute(
+            db.select(gm.c.user_id, gm.c.group_id, func.count(gmsg.c.id))
+            .select_from(gm.join(gmsg, gmsg.c.group_id == gm.c.group_id))
+            .where(
+                gm.c.status == "accepted",
+                gmsg.c.id > func.coalesce(gm.c.last_read_message_id, 0),
+                gmsg.c.sender_id != gm.c.user_id,
+            )
+            .group_by(gm.c.user_id, gm.c.group_id)
+        ):
+            rows[(int(uid), "group", int(gid))]["unread_count"] = int(cnt)
+
+        if not rows:
+            return
+        last_msgs = {}
+        for model, conv_type in ((Message, "dm"), (GroupMessage, "group")):
+            ids = sorted({r["last_message_id"] for k, r in rows.items() if k[1] == conv_type and r["last_message_id"]})
+            for i in range(0, len(ids), 500):
+                for msg in model.query.filter(model.id.in_(ids[i:i + 500])).all():
+                    last_msgs[(conv_type, int(msg.id))] = msg
+
+        values = []
+        for (uid, conv_type, conv_id), r in rows.items():
+            msg = last_msgs.get((conv_type, r["last_message_id"]))
+            values.append({
+                "user_id": uid,
+                "conversation_type": conv_type,
+                "conversation_id": conv_id,
+                "last_message_id": r["last_message_id"],
+                "last_message_at": msg.timestamp if msg else None,
+                "last_preview": _message_preview(msg) if msg else None,
+                "unread_count": r["unread_count"],
+            })
+        conn = db.session.connection()
+        t = ConversationSummary.__table__
+        for i in range(0, len(values), 500):
+            conn.execute(_insert_ignoring_conflicts(conn, t), values[i:i + 500])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("DB migration (conversation_summary backfill) failed")
+
+
+def _backfill_conversation_keys():
+    """Fill messages.conversation_key for rows written before the column existed."""
+    t = Message.__table__
+    lo = case((t.c.sender_id <= t.c.receiver_id, t.c.sender_id), else_=t.c.receiver_id)
+    hi = case((t.c.sender_id <= t.c.receiver_id, t.c.receiver_id), else_=t.c.sender_id)
+    try:
+        db.session.execute(
+            t.update()
+            .where(t.c.conversation_key.is_(None))
+            .values(conversation_key=db.cast(lo, db.String) + ":" + db.cast(hi, db.String))
+        )
+        db.session.commit()
+        # create_all() does not add indexes to tables that already exist
+        for idx in t.indexes:
+            if idx.name == "ix_messages_conv_key_id":
+                idx.create(db.engine, checkfirst=True)
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("DB migration (messages.conversation_key) failed")
+
+
+def _migrate_group_receipts_to_watermarks():
+    """Fill GroupMember read/delivered watermarks for rows that predate them.
+
+    The read watermark is the newest of: the last message with a legacy read receipt,
+    and the last message sent before last_read_at (or responded_at/invited_at).
+    Rows with nothing read get 0 so they are not migrated again.
+    """
+    gm = GroupMember.__table__
+    r = GroupMessageReceipt.__table__
+    msgs = GroupMessage.__table__
+
+    def _receipt_max(col):
+        return (
+            db.select(func.max(r.c.group_message_id))
+            .select_from(r.join(msgs, msgs.c.id == r.c.group_message_id))
+            .where(r.c.user_id == gm.c.user_id, msgs.c.group_id == gm.c.group_id, col.isnot(None))
+            .scalar_subquery()
+        )
+
+    def _greatest(a, b):
+        a = func.coalesce(a, 0)
+        b = func.coalesce(b, 0)
+        return case((a > b, a), else_=b)
+
+    ts_read = (
+        db.select(func.max(msgs.c.id))
+        .where(
+            msgs.c.group_id == gm.c.group_id,
+            msgs.c.timestamp <= func.coalesce(gm.c.last_read_at, gm.c.responded_at, gm.c.invited_at),
+        )
+        .scalar_subquery()
+    )
+    try:
+        db.session.execute(
+            gm.update()
+            .where(gm.c.last_read_message_id.is_(None), gm.c.status == "accepted")
+            .values(last_read_message_id=_greatest(_receipt_max(r.c.read_at), ts_read))
+        )
+        db.session.execute(
+            gm.update()
+            .where(gm.c.last_delivered_message_id.is_(None), gm.c.last_read_message_id.isnot(None))
+            .values(last_delivered_message_id=_greatest(_receipt_max(r.c.delivered_at), gm.c.last_read_message_id))
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("DB migration (group receipt watermarks) failed")
 
 
 
@@ -1070,7 +2553,13 @@ def register():
 
             now = datetime.now(timezone.utc).replace(tzinfo=None)
             existing_groups = Group.query.all()
+            group_max_ids = dict(
+                db.session.query(GroupMessage.group_id, func.max(GroupMessage.id))
+                .group_by(GroupMessage.group_id)
+                .all()
+            )
             for g in existing_groups:
+                joined_at_id = int(group_max_ids.get(g.id) or 0)
                 db.session.add(
                     GroupMember(
                         group_id=g.id,
@@ -1079,7 +2568,9 @@ def register():
                         invited_by=g.owner_id,
                         invited_at=now,
                         responded_at=now,
-                        last_read_at=now
+                        last_read_at=now,
+                        last_read_message_id=joined_at_id,
+                        last_delivered_message_id=joined_at_id,
                     )
                 )
                 db.session.add(
@@ -1205,139 +2696,17 @@ def web_chat():
         except ValueError:
             active_group = None
 
-    # Groups (accepted) with latest message timestamp
-    group_last_subq = (
-        db.session.query(
-            GroupMessage.group_id.label("group_id"),
-            func.max(GroupMessage.timestamp).label("last_ts"),
-        )
-        .group_by(GroupMessage.group_id)
-        .subquery()
-    )
-
-    group_rows = (
-        db.session.query(Group, group_last_subq.c.last_ts)
-        .join(GroupMember, GroupMember.group_id == Group.id)
-        .outerjoin(GroupBlock, and_(GroupBlock.group_id == Group.id, GroupBlock.user_id == user.id))
-        .outerjoin(group_last_subq, group_last_subq.c.group_id == Group.id)
-        .filter(
-            GroupMember.user_id == user.id,
-            GroupMember.status == "accepted",
-            GroupBlock.id == None  # noqa: E711
-        )
-        .order_by(func.coalesce(group_last_subq.c.last_ts, Group.created_at).desc(), Group.id.desc())
-        .all()
-    )
-
-    # إزالة تكرارات المجموعات (نفس الاسم لنفس المنشئ) - نعرض الأحدث فقط
-    _seen = {}
-    for g, last_ts in group_rows:
-        key = (g.owner_id, (g.name or "").strip().lower())
-        if key not in _seen or (g.id or 0) > (_seen[key][0].id or 0):
-            _seen[key] = (g, last_ts)
-    groups = list(_seen.values())
-
-    # Direct message latest timestamps
-    other_id = case(
-        (Message.sender_id == user.id, Message.receiver_id),
-        else_=Message.sender_id,
-    )
-    dm_last_subq = (
-        db.session.query(other_id.label("other_id"), func.max(Message.timestamp).label("last_ts"))
-        .filter(or_(Message.sender_id == user.id, Message.receiver_id == user.id))
-        .group_by(other_id)
-        .subquery()
-    )
-
-    dm_rows = (
-        db.session.query(User, dm_last_subq.c.last_ts)
-        .outerjoin(dm_last_subq, dm_last_subq.c.other_id == User.id)
-        .filter(User.id != user.id)
-        .order_by(dm_last_subq.c.last_ts.desc().nullslast(), User.id.desc())
-        .all()
-    )
-
-    # Build conversations list (Users + Groups) then sort by latest
+    # The sidebar is loaded page by page from /api/conversations; only the active
+    # conversation is rendered here so it is selectable before the first page arrives.
     conversations = []
-    for g, last_ts in groups:
-        conversations.append({"type": "group", "group": g, "ts": last_ts or g.created_at})
-    for u, last_ts in dm_rows:
-        conversations.append({"type": "user", "user": u, "ts": last_ts})
-
-    # Ensure active conversation is present even if outside the preview list
-    if active_group and not any(c.get("type") == "group" and c.get("group").id == active_group.id for c in conversations):
-        conversations.append({"type": "group", "group": active_group, "ts": active_group.created_at})
-    if active_user and not any(c.get("type") == "user" and c.get("user").id == active_user.id for c in conversations):
-        conversations.append({"type": "user", "user": active_user, "ts": None})
-
-    
-    # Attach conversation settings (pin/archive/mute) for current user
-    conv_keys = []
-    for c in conversations:
-        if c.get("type") == "group":
-            conv_keys.append(("group", int(c.get("group").id)))
-        else:
-            conv_keys.append(("dm", int(c.get("user").id)))
-    settings_rows = (
-        ConversationSetting.query
-        .filter(ConversationSetting.user_id == user.id)
-        .filter(
-            or_(
-                and_(ConversationSetting.conversation_type == "group", ConversationSetting.conversation_id.in_([cid for t, cid in conv_keys if t == "group"] or [-1])),
-                and_(ConversationSetting.conversation_type == "dm", ConversationSetting.conversation_id.in_([cid for t, cid in conv_keys if t == "dm"] or [-1])),
-            )
-        )
-        .all()
-    )
-    settings_map = {(r.conversation_type, int(r.conversation_id)): r for r in settings_rows}
-    for c in conversations:
-        if c.get("type") == "group":
-            c["settings"] = settings_map.get(("group", int(c.get("group").id)))
-        else:
-            c["settings"] = settings_map.get(("dm", int(c.get("user").id)))
-
-    # ترتيب مثل واتساب: المثبت أولاً (حسب pinned_rank) ثم حسب آخر رسالة، والأرشيف في الأسفل
-    def _conv_name(it):
-        if it.get("type") == "user":
-            return ((it.get("user").name or "").lower(), int(it.get("user").id))
-        return ((it.get("group").name or "").lower(), int(it.get("group").id))
-
-    def _pinned_rank(it):
-        s = it.get("settings")
-        if s and s.pinned_rank is not None:
-            return int(s.pinned_rank)
-        return 10**9
-
-    def _is_archived(it):
-        s = it.get("settings")
-        return bool(s and s.is_archived)
-
-    conversations.sort(key=lambda it: (_conv_name(it)))
-    conversations.sort(
-        key=lambda it: (
-            _is_archived(it),                 # archived last
-            _pinned_rank(it),                 # pinned first
-            not (it.get("ts") is not None),   # ts present first
-            -(it.get("ts").timestamp() if it.get("ts") else 0.0),
-        )
-    )
-
-
-    if CONVERSATION_PREVIEW_LIMIT and len(conversations) > CONVERSATION_PREVIEW_LIMIT:
-        limited = conversations[:CONVERSATION_PREVIEW_LIMIT]
-        active_entries = []
-        if active_group:
-            active_entries = [c for c in conversations if c.get("type") == "group" and c.get("group").id == active_group.id]
-        if not active_entries and active_user:
-            active_entries = [c for c in conversations if c.get("type") == "user" and c.get("user").id == active_user.id]
-        if active_entries and active_entries[0] not in limited:
-            limited.pop(-1)
-            limited.append(active_entries[0])
-            limited.sort(
-                key=lambda it: (it.get("ts") is not None, it.get("ts") or datetime.min),
-                reverse=True,
-            )
-        conversations = limited
+    if active_group:
+        row = _conversation_row(user.id, "group", active_group.id)
+        if row:
+            conversations.append(_serialize_conversation(row, user.id))
+    elif active_user:
+        row = _conversation_row(user.id, "user", active_user.id)
+        if row:
+            conversations.append(_serialize_conversation(row, user.id))
 
     pending_group_invites = (
         GroupMember.query.options(joinedload(GroupMember.group))
@@ -1362,8 +2731,6 @@ def web_chat():
     return render_template(
         "chat.html",
         current_user=user,
-        users=[],
-        groups=[g for g, _ in groups],
         conversations=conversations,
         pending_group_invites=[
             {
@@ -1381,6 +2748,43 @@ def web_chat():
     )
 
 
+@app.route("/api/conversations", methods=["GET"])
+def api_conversations():
+    """One page of the sidebar: ?limit=&cursor= (cursor is the previous page's next_cursor)."""
+    if not login_required():
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    me = int(session["user_id"])
+    limit = _parse_page_limit(
+        request.args.get("limit"), default=CONVERSATION_PAGE_LIMIT, maximum=CONVERSATION_PAGE_MAX, minimum=1
+    )
+    cursor = None
+    raw_cursor = (request.args.get("cursor") or "").strip()
+    if raw_cursor:
+        cursor = _parse_conversation_cursor(raw_cursor)
+        if cursor is None:
+            return jsonify({"ok": False, "error": "bad_cursor"}), 400
+    rows, next_cursor = _conversation_page(me, limit, cursor)
+    return jsonify({
+        "ok": True,
+        "conversations": [_serialize_conversation(r, me) for r in rows],
+        "next_cursor": next_cursor,
+    })
+
+
+@app.route("/api/conversations/<conv_type>/<int:conv_id>", methods=["GET"])
+def api_conversation_item(conv_type: str, conv_id: int):
+    """A single sidebar entry (dm|group), for conversations not yet loaded into the sidebar."""
+    if not login_required():
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    if conv_type not in ("dm", "group"):
+        return jsonify({"ok": False, "error": "bad_type"}), 400
+    me = int(session["user_id"])
+    row = _conversation_row(me, "user" if conv_type == "dm" else "group", conv_id)
+    if not row:
+        return jsonify({"ok": False, "error": "not_found"}), 404
+    return jsonify({"ok": True, "conversation": _serialize_conversation(row, me)})
+
+
 @app.route("/api/users/<int:user_id>/presence")
 def api_user_presence(user_id: int):
     if not login_required():
@@ -1459,7 +2863,8 @@ def create_group():
         db.session.flush()
 
         # أضف المالك كعضو accepted
-        db.session.add(GroupMember(group_id=g.id, user_id=me.id, status="accepted", invited_by=me.id, role="owner"))
+        db.session.add(GroupMember(group_id=g.id, user_id=me.id, status="accepted", invited_by=me.id, role="owner",
+                                   last_read_message_id=0, last_delivered_message_id=0))
 
         # أضف الأعضاء كطلبات pending + أرسل لهم رسالة دعوة
         for uid in members:
@@ -1477,6 +2882,9 @@ def create_group():
                 pass
 
         db.session.commit()
+        # Invite counts are not part of the per-conversation deltas: ask invitees to refetch
+        for uid in members:
+            socketio.emit("refresh_unread", {"type": "invites"}, room=f"user_{uid}")
         return jsonify({"ok": True, "group": {"id": g.id, "name": g.name}})
     except SQLAlchemyError as e:
         db.session.rollback()
@@ -1562,6 +2970,7 @@ def respond_group_invite():
     gm.responded_at = datetime.now(timezone.utc).replace(tzinfo=None)
     try:
         if gm.status == "accepted":
+            gm.last_read_message_id = gm.last_delivered_message_id = _group_max_message_id(gm.group_id)
             try:
                 db.session.add(
                     GroupMessage(
@@ -1574,6 +2983,7 @@ def respond_group_invite():
             except Exception:
                 pass
         db.session.commit()
+        _forget_group_media_access(gm.group_id, me.id)
         return jsonify({"ok": True, "status": gm.status})
     except SQLAlchemyError:
         db.session.rollback()
@@ -1685,17 +3095,29 @@ def api_group_delete(group_id):
     if g.owner_id != me.id:
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
+    unused_media = []
     try:
         # Remove related records first
         GroupMember.query.filter_by(group_id=group_id).delete(synchronize_session=False)
+        media_refs = db.session.execute(
+            db.select(GroupMessage.media_url, func.count())
+            .where(GroupMessage.group_id == group_id, GroupMessage.media_url.isnot(None))
+            .group_by(GroupMessage.media_url)
+        ).all()
+        unused_media = _media_release(media_refs)
+        MediaObject.query.filter_by(conversation_type="group", conversation_ref=str(group_id)).delete(synchronize_session=False)
         GroupMessage.query.filter_by(group_id=group_id).delete(synchronize_session=False)
         GroupBlock.query.filter_by(group_id=group_id).delete(synchronize_session=False)
+        ConversationSummary.query.filter_by(conversation_type="group", conversation_id=group_id).delete(synchronize_session=False)
 
         db.session.delete(g)
         db.session.commit()
+        _forget_group_media_access(group_id)
+        _remove_media_files(unused_media)
         return jsonify({"ok": True})
     except SQLAlchemyError:
         db.session.rollback()
+        _restore_media_files(unused_media)
         return jsonify({"ok": False, "error": "db_error"}), 500
 
 
@@ -1741,7 +3163,12 @@ def api_group_leave(group_id):
                     message_type="system",
                 )
             )
+        # Flushes the pending rows first, so the leave message can't re-create this row
+        ConversationSummary.query.filter_by(
+            user_id=me.id, conversation_type="group", conversation_id=group_id
+        ).delete(synchronize_session=False)
         db.session.commit()
+        _forget_group_media_access(group_id, me.id)
         return jsonify({"ok": True})
     except SQLAlchemyError:
         db.session.rollback()
@@ -1769,10 +3196,12 @@ def api_group_block(group_id):
         if existing:
             db.session.delete(existing)
             db.session.commit()
+            _forget_group_media_access(group_id, me.id)
             return jsonify({"ok": True, "blocked": False})
         else:
             db.session.add(GroupBlock(group_id=group_id, user_id=me.id))
             db.session.commit()
+            _forget_group_media_access(group_id, me.id)
             return jsonify({"ok": True, "blocked": True})
     except SQLAlchemyError:
         db.session.rollback()
@@ -1844,13 +3273,17 @@ def join_by_token(token: str):
 
     try:
         gm = GroupMember.query.filter_by(group_id=g.id, user_id=me.id).first()
+        joined_at_id = _group_max_message_id(g.id)
         if not gm:
-            gm = GroupMember(group_id=g.id, user_id=me.id, status="accepted", invited_by=link.created_by, role="member")
+            gm = GroupMember(group_id=g.id, user_id=me.id, status="accepted", invited_by=link.created_by, role="member",
+                             last_read_message_id=joined_at_id, last_delivered_message_id=joined_at_id)
             db.session.add(gm)
-        else:
+        elif gm.status != "accepted":
             gm.status = "accepted"
+            gm.last_read_message_id = gm.last_delivered_message_id = joined_at_id
         link.uses = int(link.uses or 0) + 1
         db.session.commit()
+        _forget_group_media_access(g.id, me.id)
         return redirect(url_for("web_chat", group=g.id))
     except Exception:
         db.session.rollback()
@@ -1871,83 +3304,46 @@ def get_group_messages(group_id: int):
     if not member:
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    last_id = (request.args.get("last_id") or "0").strip()
-    limit_raw = request.args.get("limit", str(MESSAGE_PAGE_LIMIT))
-    try:
-        limit = int(limit_raw)
-    except ValueError:
-        limit = MESSAGE_PAGE_LIMIT
-    if limit < 20:
-        limit = 20
-    if limit > 200:
-        limit = 200
-    min_id = 0
-    try:
-        if int(last_id) > 0:
-            min_id = int(last_id)
-    except ValueError:
-        pass
-
-    q = GroupMessage.query.filter(GroupMessage.group_id == group_id).options(joinedload(GroupMessage.sender))
-
-    is_initial = min_id == 0
-    if is_initial:
-        msgs_desc = q.order_by(GroupMessage.timestamp.desc(), GroupMessage.id.desc()).limit(limit).all()
-        messages = list(reversed(msgs_desc))
-    else:
-        q = q.filter(GroupMessage.id > min_id)
-        messages = q.order_by(GroupMessage.timestamp.asc(), GroupMessage.id.asc()).all()
+    # Cursors: before_id (scroll back) / after_id (catch up). last_id is the legacy after_id.
+    # Cursor requests get {"messages": [...], "has_more": bool}; legacy ones keep the bare array.
+    use_envelope = "before_id" in request.args or "after_id" in request.args
+    limit = _parse_page_limit(request.args.get("limit"))
+    before_id = _parse_cursor_id(request.args.get("before_id"))
+    after_id = _parse_cursor_id(request.args.get("after_id")) or _parse_cursor_id(request.args.get("last_id"))
+
+    q = (
+        GroupMessage.query
+        .filter(GroupMessage.group_id == group_id)
+        .filter(_not_hidden_for(me.id, "group", GroupMessage.id))
+    )
 
-    # Filter "delete for me" visibilities for group messages
-    try:
-        deleted_ids = {
-            int(r[0]) for r in db.session.query(MessageVisibility.message_id)
-            .filter_by(user_id=me.id, message_type="group", is_deleted_for_me=True)
-            .all()
-        }
-    except Exception:
-        deleted_ids = set()
+    messages, has_more = _keyset_page(q, GroupMessage, limit, before_id=before_id, after_id=after_id)
 
-    res = []
-    for m in messages:
-        if int(m.id) in deleted_ids:
-            continue
-        # Group read receipts (best-effort): mark read for this user
-        try:
-            if int(m.sender_id) != int(me.id):
-                now = datetime.now(timezone.utc).replace(tzinfo=None)
-                rec = GroupMessageReceipt.query.filter_by(group_message_id=m.id, user_id=me.id).first()
-                if not rec:
-                    rec = GroupMessageReceipt(group_message_id=m.id, user_id=me.id, delivered_at=now, read_at=now)
-                    db.session.add(rec)
-                else:
-                    if rec.delivered_at is None:
-                        rec.delivered_at = now
-                    if rec.read_at is None:
-                        rec.read_at = now
-        except Exception:
-            pass
-        res.append({
-            "id": m.id,
-            "sender_id": m.sender_id,
-            "receiver_id": None,
-            "sender_name": m.sender.name if m.sender else "",
-            "content": m.content or "",
-            "message_type": m.message_type,
-            "media_url": m.media_url,
-            "media_mime": m.media_mime,
-            "timestamp_iso": _utc_iso(m.timestamp),
-            "timestamp_ms": _utc_ms(m.timestamp),
-        })
+    res = _serialize_messages(messages, viewer_id=me.id)
 
     # Frontend expects an array like /get_messages
 
-    # Update last_read_at for unread counts
+    # Advance read/delivered watermarks to the newest message on this page
+    unread_left = None
     try:
+        if messages:
+            read_upto = max(int(member.last_read_message_id or 0), max(int(m.id) for m in messages))
+            if read_upto > int(member.last_read_message_id or 0):
+                _advance_group_watermarks(member.id, read_upto)
+                unread_left = db.session.execute(
+                    db.select(func.count(GroupMessage.id))
+                    .where(GroupMessage.group_id == group_id, GroupMessage.sender_id != me.id, GroupMessage.id > read_upto)
+                ).scalar() or 0
+                _summary_set_unread(me.id, "group", group_id, unread_left)
         member.last_read_at = datetime.now(timezone.utc).replace(tzinfo=None)
         db.session.commit()
     except Exception:
         db.session.rollback()
+        unread_left = None
+    if unread_left is not None:
+        _emit_unread_update(f"user_{me.id}", "group", group_id, unread=int(unread_left))
+    if use_envelope:
+        return jsonify({"ok": True, "messages": res, "has_more": has_more})
     return jsonify(res)
 
 
@@ -1966,39 +3362,106 @@ def api_group_message_delete_for_me(message_id: int):
         return jsonify({"ok": False, "error": "forbidden"}), 403
     try:
         row = MessageVisibility.query.filter_by(message_type="group", message_id=message_id, user_id=me.id).first()
+        was_visible = not (row and row.is_deleted_for_me)
         if not row:
             db.session.add(MessageVisibility(message_type="group", message_id=message_id, user_id=me.id, is_deleted_for_me=True))
         else:
             row.is_deleted_for_me = True
+        _summary_refresh_last(me.id, "group", msg.group_id)
+        # A hidden message above the read watermark no longer counts as unread
+        unread = None
+        if was_visible and int(msg.sender_id) != int(me.id) and int(msg.id) > int(member.last_read_message_id or 0):
+            unread = _summary_drop_unread(me.id, "group", msg.group_id)
         db.session.commit()
+        if unread is not None:
+            _emit_unread_update(f"user_{me.id}", "group", msg.group_id, unread=unread)
         return jsonify({"ok": True})
     except Exception:
         db.session.rollback()
         return jsonify({"ok": False, "error": "db_error"}), 500
 
 
-@app.route("/send_group_message", methods=["POST"])
-def send_group_message():
+@app.route("/api/group_messages/<int:message_id>/receipts", methods=["GET"])
+def api_group_message_receipts(message_id: int):
+    """Who has read / received a group message, derived from member watermarks."""
     if not login_required():
         return jsonify({"ok": False, "error": "unauthorized"}), 401
-    me = current_user()
-    if not me:
-        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    me = int(session["user_id"])
+    msg = db.session.get(GroupMessage, message_id)
+    if not msg:
+        return jsonify({"ok": False, "error": "not_found"}), 404
+    member = GroupMember.query.filter_by(group_id=msg.group_id, user_id=me, status="accepted").first()
+    if not member:
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    try:
+        rows = (
+            db.session.query(GroupMember.user_id, User.name, GroupMember.last_read_message_id, GroupMember.last_delivered_message_id)
+            .join(User, GroupMember.user_id == User.id)
+            .filter(
+                GroupMember.group_id == msg.group_id,
+                GroupMember.status == "accepted",
+                GroupMember.user_id != msg.sender_id,
+            )
+            .order_by(User.name.asc())
+            .all()
+        )
+        read_by = []
+        delivered_to = []
+        for uid, name, read_wm, delivered_wm in rows:
+            entry = {"user_id": int(uid), "name": name}
+            if int(read_wm or 0) >= int(msg.id):
+                read_by.append(entry)
+            elif max(int(delivered_wm or 0), int(read_wm or 0)) >= int(msg.id):
+                delivered_to.append(entry)
+        return jsonify({
+            "ok": True,
+            "message_id": int(msg.id),
+            "read_by": read_by,
+            "delivered_to": delivered_to,
+            "read_count": len(read_by),
+            "delivered_count": len(read_by) + len(delivered_to),
+            "total": len(rows),
+        })
+    except Exception:
+        return jsonify({"ok": False, "error": "db_error"}), 500
+
+
+def _clean_client_msg_id(raw) -> Optional[str]:
+    v = str(raw or "").strip()
+    return v if 0 < len(v) <= 64 else None
+
+
+def _already_sent(model, sender_id: int, client_msg_id: Optional[str]) -> Optional[tuple[dict, int]]:
+    """Response for a retried send whose client_msg_id is already stored (no fan-out)."""
+    if not client_msg_id:
+        return None
+    msg = model.query.filter_by(sender_id=sender_id, client_msg_id=client_msg_id).first()
+    if not msg:
+        return None
+    return {"status": "ok", "message": _serialize_message(msg, viewer_id=sender_id), "duplicate": True}, 200
+
+
+def _send_group_text(sender_id: int, group_id_raw, content, reply_to_raw=None,
+                     client_msg_id=None) -> tuple[dict, int]:
+    """Store and fan out a group text message; returns (response body, HTTP status).
 
-    group_id = (request.form.get("group_id") or "").strip()
-    content = (request.form.get("content") or "").strip()
-    reply_to_raw = (request.form.get("reply_to_id") or "").strip()
+    Shared by the /send_group_message endpoint and the send_message Socket.IO event.
+    A repeated client_msg_id returns the stored message without re-running fan-out.
+    """
+    client_msg_id = _clean_client_msg_id(client_msg_id)
+    content = str(content or "").strip()
+    reply_to_raw = str(reply_to_raw or "").strip()
     try:
-        group_id = int(group_id)
+        group_id = int(str(group_id_raw or "").strip())
     except Exception:
-        return jsonify({"ok": False, "error": "bad_request"}), 400
+        return {"ok": False, "error": "bad_request"}, 400
 
-    member = GroupMember.query.filter_by(group_id=group_id, user_id=me.id, status="accepted").first()
+    member = GroupMember.query.filter_by(group_id=group_id, user_id=sender_id, status="accepted").first()
     if not member:
-        return jsonify({"ok": False, "error": "forbidden"}), 403
+        return {"ok": False, "error": "forbidden"}, 403
 
     if not content:
-        return jsonify({"ok": False, "error": "empty"}), 400
+        return {"ok": False, "error": "empty"}, 400
 
     # Optional reply_to_id: must exist inside the same group
     reply_to_id = None
@@ -2011,69 +3474,78 @@ def send_group_message():
         except Exception:
             reply_to_id = None
 
-    msg = GroupMessage(group_id=group_id, sender_id=me.id, content=content, message_type="text", reply_to_id=reply_to_id)
+    dup = _already_sent(GroupMessage, sender_id, client_msg_id)
+    if dup:
+        return dup
+
+    msg = GroupMessage(
+        group_id=group_id, sender_id=sender_id, content=content, message_type="text",
+        reply_to_id=reply_to_id, client_msg_id=client_msg_id,
+    )
     try:
         db.session.add(msg)
-        db.session.commit()
+        db.session.flush()
 
-        # Detect mentions in message content (e.g., @+201234567890)
-        try:
-            mentioned_users: set[int] = set()
-            for ph in re.findall(r"@\+?[0-9]{10,15}", content or ""):
-                phone = ph[1:]
-                u = User.query.filter_by(phone_number=phone).first()
-                if u and int(u.id) != int(me.id):
-                    mentioned_users.add(int(u.id))
-                    try:
-                        db.session.add(GroupMessageMention(group_message_id=msg.id, mentioned_user_id=int(u.id)))
-                    except Exception:
-                        pass
-            if mentioned_users:
-                db.session.commit()
-        except Exception:
-            db.session.rollback()
+        # Detect mentions in message content (e.g., @+201234567890); one IN query on the
+        # indexed phone_number, rows committed together with the message
+        phones = {ph[1:] for ph in MENTION_RE.findall(content or "")}
+        if phones:
+            mentioned_ids = db.session.execute(
+                db.select(User.id).where(User.phone_number.in_(phones), User.id != sender_id)
+            ).scalars().all()
+            db.session.add_all(
+                GroupMessageMention(group_message_id=msg.id, mentioned_user_id=int(uid)) for uid in mentioned_ids
+            )
+        db.session.commit()
 
         # Web Push notification to other group members
         try:
-            sender = User.query.get(me.id)
-            members = GroupMember.query.filter_by(group_id=group_id, status="accepted").all()
-            for mm in members:
-                if mm.user_id == me.id:
-                    continue
-                payload = {
-                    "title": "👥 رسالة جديدة في المجموعة",
-                    "body": f"{(sender.name if sender else 'مستخدم')}: {(content[:120] if content else '')}",
-                    "icon": "/static/logo.svg",
-                    "badge": "/static/logo.svg",
-                    "url": f"/chat?group={group_id}",
-                    "tag": f"group-{group_id}-{msg.id}",
-                    "meta": {"type": "group", "group_id": group_id, "sender_id": me.id, "message_id": msg.id}
-                }
-                if not is_conversation_muted(mm.user_id, 'group', group_id):
-
-                    send_push_to_user(mm.user_id, payload)
+            sender = User.query.get(sender_id)
+            # Only members with a device to notify and the group not muted; one query
+            recipients = _group_push_recipients(group_id, sender_id)
+            payload = {
+                "title": "👥 رسالة جديدة في المجموعة",
+                "body": f"{(sender.name if sender else 'مستخدم')}: {(content[:120] if content else '')}",
+                "icon": "/static/logo.svg",
+                "badge": "/static/logo.svg",
+                "url": f"/chat?group={group_id}",
+                "tag": f"group-{group_id}-{msg.id}",
+                "meta": {"type": "group", "group_id": group_id, "sender_id": sender_id, "message_id": msg.id}
+            }
+            enqueue_pushes(recipients, payload, coalesce_key=f"group-{group_id}", coalesce_label=_group_push_label(group_id))
         except Exception:
-            pass
+            # The message is committed: leave the session usable for the emits below
+            db.session.rollback()
+            app.logger.exception("Queueing push notifications failed")
 
-        _emit_group_message(msg)
+        payload = _emit_group_message(msg)
 
-        return jsonify({
-            "status": "ok",
-            "message": {
-                "id": msg.id,
-                "sender_id": msg.sender_id,
-                "receiver_id": None,
-                "content": msg.content,
-                "timestamp_iso": _utc_iso(msg.timestamp),
-                "timestamp_ms": _utc_ms(msg.timestamp),
-                "message_type": msg.message_type,
-                "media_url": msg.media_url,
-                "media_mime": msg.media_mime,
-            }
-        })
+        return {"status": "ok", "message": payload}, 200
+    except IntegrityError:
+        # A concurrent retry with the same client_msg_id won the insert
+        db.session.rollback()
+        return _already_sent(GroupMessage, sender_id, client_msg_id) or ({"error": "database_error"}, 500)
     except SQLAlchemyError:
         db.session.rollback()
-        return jsonify({"error": "database_error"}), 500
+        return {"error": "database_error"}, 500
+
+
+@app.route("/send_group_message", methods=["POST"])
+def send_group_message():
+    if not login_required():
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    me = current_user()
+    if not me:
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+
+    body, status = _send_group_text(
+        me.id,
+        request.form.get("group_id"),
+        request.form.get("content"),
+        request.form.get("reply_to_id"),
+        request.form.get("client_msg_id"),
+    )
+    return jsonify(body), status
 
 
 # ---- Messages API ----
@@ -2113,64 +3585,47 @@ def send_group_image():
     if size > 8 * 1024 * 1024:
         return jsonify({"error": "حجم الصورة كبير"}), 400
 
-    from uuid import uuid4
     filename = secure_filename(f.filename or "image")
     ext = os.path.splitext(filename)[1].lower()
     if ext not in [".jpg", ".jpeg", ".png", ".gif", ".webp"]:
         ext = ".png"
 
-    upload_dir = os.path.join(app.root_path, "static", "uploads", "images")
-    os.makedirs(upload_dir, exist_ok=True)
-    new_name = f"g{group_id}_{me.id}_{uuid4().hex}{ext}"
-    save_path = os.path.join(upload_dir, new_name)
-    f.save(save_path)
-
-    url = url_for("static", filename=f"uploads/images/{new_name}")
+    url, blob = store_media_upload(f, "images", ext)
     msg = GroupMessage(group_id=group_id, sender_id=me.id, content="", message_type="image", media_url=url, media_mime=mimetype)
     try:
         db.session.add(msg)
+        _media_blob_ref(blob, msg)
+        has_derivatives = _attach_image_derivatives(msg, blob)
         db.session.commit()
+        if not has_derivatives:
+            _queue_image_derivatives(msg, blob)
 
         # Web Push notification to other group members
         try:
             sender = User.query.get(me.id)
-            members = GroupMember.query.filter_by(group_id=group_id, status="accepted").all()
-            for mm in members:
-                if mm.user_id == me.id:
-                    continue
-                payload = {
-                    "title": "🖼️ صورة جديدة في المجموعة",
-                    "body": f"{(sender.name if sender else 'مستخدم')}: أرسل صورة",
-                    "icon": "/static/logo.svg",
-                    "badge": "/static/logo.svg",
-                    "url": f"/chat?group={group_id}",
-                    "tag": f"group-{group_id}-{msg.id}",
-                    "meta": {"type": "group", "group_id": group_id, "sender_id": me.id, "message_id": msg.id}
-                }
-                if not is_conversation_muted(mm.user_id, 'group', group_id):
-
-                    send_push_to_user(mm.user_id, payload)
+            # Only members with a device to notify and the group not muted; one query
+            recipients = _group_push_recipients(group_id, me.id)
+            payload = {
+                "title": "🖼️ صورة جديدة في المجموعة",
+                "body": f"{(sender.name if sender else 'مستخدم')}: أرسل صورة",
+                "icon": "/static/logo.svg",
+                "badge": "/static/logo.svg",
+                "url": f"/chat?group={group_id}",
+                "tag": f"group-{group_id}-{msg.id}",
+                "meta": {"type": "group", "group_id": group_id, "sender_id": me.id, "message_id": msg.id}
+            }
+            enqueue_pushes(recipients, payload, coalesce_key=f"group-{group_id}", coalesce_label=_group_push_label(group_id))
         except Exception:
-            pass
+            # The message is committed: leave the session usable for the emits below
+            db.session.rollback()
+            app.logger.exception("Queueing push notifications failed")
 
-        _emit_group_message(msg)
+        payload = _emit_group_message(msg)
 
-        return jsonify({
-            "status": "ok",
-            "message": {
-                "id": msg.id,
-                "sender_id": msg.sender_id,
-                "receiver_id": None,
-                "content": msg.content,
-                "timestamp_iso": _utc_iso(msg.timestamp),
-                "timestamp_ms": _utc_ms(msg.timestamp),
-                "message_type": msg.message_type,
-                "media_url": msg.media_url,
-                "media_mime": msg.media_mime,
-            }
-        })
+        return jsonify({"status": "ok", "message": payload})
     except SQLAlchemyError:
         db.session.rollback()
+        _media_discard_upload(blob)
         return jsonify({"error": "database_error"}), 500
 
 
@@ -2208,64 +3663,44 @@ def send_group_audio():
     if size > 12 * 1024 * 1024:
         return jsonify({"error": "حجم الملف كبير"}), 400
 
-    from uuid import uuid4
     filename = secure_filename(f.filename or "audio")
     ext = os.path.splitext(filename)[1].lower()
     if not ext:
         ext = ".webm"
 
-    upload_dir = os.path.join(app.root_path, "static", "uploads", "audio")
-    os.makedirs(upload_dir, exist_ok=True)
-    new_name = f"g{group_id}_{me.id}_{uuid4().hex}{ext}"
-    save_path = os.path.join(upload_dir, new_name)
-    f.save(save_path)
-
-    url = url_for("static", filename=f"uploads/audio/{new_name}")
+    url, blob = store_media_upload(f, "audio", ext)
     msg = GroupMessage(group_id=group_id, sender_id=me.id, content="", message_type="audio", media_url=url, media_mime=mimetype)
     try:
         db.session.add(msg)
+        _media_blob_ref(blob, msg)
         db.session.commit()
 
         # Web Push notification to other group members
         try:
             sender = User.query.get(me.id)
-            members = GroupMember.query.filter_by(group_id=group_id, status="accepted").all()
-            for mm in members:
-                if mm.user_id == me.id:
-                    continue
-                payload = {
-                    "title": "🎤 رسالة صوتية في المجموعة",
-                    "body": f"{(sender.name if sender else 'مستخدم')}: أرسل رسالة صوتية",
-                    "icon": "/static/logo.svg",
-                    "badge": "/static/logo.svg",
-                    "url": f"/chat?group={group_id}",
-                    "tag": f"group-{group_id}-{msg.id}",
-                    "meta": {"type": "group", "group_id": group_id, "sender_id": me.id, "message_id": msg.id}
-                }
-                if not is_conversation_muted(mm.user_id, 'group', group_id):
-
-                    send_push_to_user(mm.user_id, payload)
+            # Only members with a device to notify and the group not muted; one query
+            recipients = _group_push_recipients(group_id, me.id)
+            payload = {
+                "title": "🎤 رسالة صوتية في المجموعة",
+                "body": f"{(sender.name if sender else 'مستخدم')}: أرسل رسالة صوتية",
+                "icon": "/static/logo.svg",
+                "badge": "/static/logo.svg",
+                "url": f"/chat?group={group_id}",
+                "tag": f"group-{group_id}-{msg.id}",
+                "meta": {"type": "group", "group_id": group_id, "sender_id": me.id, "message_id": msg.id}
+            }
+            enqueue_pushes(recipients, payload, coalesce_key=f"group-{group_id}", coalesce_label=_group_push_label(group_id))
         except Exception:
-            pass
+            # The message is committed: leave the session usable for the emits below
+            db.session.rollback()
+            app.logger.exception("Queueing push notifications failed")
 
-        _emit_group_message(msg)
+        payload = _emit_group_message(msg)
 
-        return jsonify({
-            "status": "ok",
-            "message": {
-                "id": msg.id,
-                "sender_id": msg.sender_id,
-                "receiver_id": None,
-                "content": msg.content,
-                "timestamp_iso": _utc_iso(msg.timestamp),
-                "timestamp_ms": _utc_ms(msg.timestamp),
-                "message_type": msg.message_type,
-                "media_url": msg.media_url,
-                "media_mime": msg.media_mime,
-            }
-        })
+        return jsonify({"status": "ok", "message": payload})
     except SQLAlchemyError:
         db.session.rollback()
+        _media_discard_upload(blob)
         return jsonify({"error": "database_error"}), 500
 
 
@@ -2296,19 +3731,13 @@ def send_group_file():
 
     mimetype = (f.mimetype or "application/octet-stream").lower()
 
-    from uuid import uuid4
     orig_name = secure_filename(f.filename or "file")
     ext = os.path.splitext(orig_name)[1].lower()
     if not ext:
         guess = mimetypes.guess_extension(mimetype) or ""
         ext = guess if len(guess) <= 10 else ""
 
-    new_name = f"{uuid4().hex}{ext}"
-    abs_path = os.path.join(app.config["MEDIA_FILE_FOLDER"], new_name)
-    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
-    f.save(abs_path)
-
-    media_url = url_for("serve_media", category="files", filename=new_name)
+    media_url, blob = store_media_upload(f, "files", ext)
     try:
         msg = GroupMessage(
             group_id=group_id,
@@ -2319,49 +3748,35 @@ def send_group_file():
             media_mime=mimetype,
         )
         db.session.add(msg)
+        _media_blob_ref(blob, msg)
         db.session.commit()
 
         # Web Push notification to other group members
-        try:
-            sender = User.query.get(sender_id)
-            members = GroupMember.query.filter_by(group_id=group_id, status="accepted").all()
-            for mm in members:
-                if mm.user_id == sender_id:
-                    continue
-                payload = {
-                    "title": "👥 ملف جديد في المجموعة",
-                    "body": f"{(sender.name if sender else 'مستخدم')}: {orig_name}",
-                    "icon": "/static/logo.svg",
-                    "badge": "/static/logo.svg",
-                    "url": f"/chat?group={group_id}",
-                    "tag": f"group-{group_id}-{msg.id}",
-                    "meta": {"type": "group", "group_id": group_id, "sender_id": sender_id, "message_id": msg.id}
-                }
-                if not is_conversation_muted(mm.user_id, 'group', group_id):
-
-                    send_push_to_user(mm.user_id, payload)
+        try:
+            sender = User.query.get(sender_id)
+            # Only members with a device to notify and the group not muted; one query
+            recipients = _group_push_recipients(group_id, sender_id)
+            payload = {
+                "title": "👥 ملف جديد في المجموعة",
+                "body": f"{(sender.name if sender else 'مستخدم')}: {orig_name}",
+                "icon": "/static/logo.svg",
+                "badge": "/static/logo.svg",
+                "url": f"/chat?group={group_id}",
+                "tag": f"group-{group_id}-{msg.id}",
+                "meta": {"type": "group", "group_id": group_id, "sender_id": sender_id, "message_id": msg.id}
+            }
+            enqueue_pushes(recipients, payload, coalesce_key=f"group-{group_id}", coalesce_label=_group_push_label(group_id))
         except Exception:
-            pass
+            # The message is committed: leave the session usable for the emits below
+            db.session.rollback()
+            app.logger.exception("Queueing push notifications failed")
 
-        _emit_group_message(msg)
+        payload = _emit_group_message(msg)
 
-        return jsonify({
-            "status": "ok",
-            "message": {
-                "id": msg.id,
-                "group_id": msg.group_id,
-                "sender_id": msg.sender_id,
-                "sender_name": msg.sender.name if msg.sender else "",
-                "content": msg.content,
-                "timestamp_iso": _utc_iso(msg.timestamp),
-                "timestamp_ms": _utc_ms(msg.timestamp),
-                "message_type": msg.message_type,
-                "media_url": msg.media_url,
-                "media_mime": msg.media_mime,
-            }
-        })
+        return jsonify({"status": "ok", "message": payload})
     except SQLAlchemyError:
         db.session.rollback()
+        _media_discard_upload(blob)
         app.logger.exception("Send group file error")
         return jsonify({"error": "فشل إرسال الملف"}), 500
 
@@ -2378,113 +3793,72 @@ def get_messages(other_user_id: int):
         return jsonify({"error": "المستخدم غير موجود"}), 404
 
     since_ms = request.args.get("since", "0")
-    last_id = request.args.get("last_id", "0")
-    limit_raw = request.args.get("limit", str(MESSAGE_PAGE_LIMIT))
 
     # حدّ آمن
-    try:
-        limit = int(limit_raw)
-    except ValueError:
-        limit = 200
-    if limit < 20:
-        limit = 20
-    if limit > 200:
-        limit = 200
+    limit = _parse_page_limit(request.args.get("limit"))
+
+    # Cursors: before_id (scroll back) / after_id (catch up). last_id is the legacy after_id.
+    # Cursor requests get {"messages": [...], "has_more": bool}; legacy ones keep the bare array.
+    use_envelope = "before_id" in request.args or "after_id" in request.args
+    before_id = _parse_cursor_id(request.args.get("before_id"))
+    after_id = _parse_cursor_id(request.args.get("after_id")) or _parse_cursor_id(request.args.get("last_id"))
 
-    last_load_time = datetime(1970, 1, 1)
-    min_id = 0
+    last_load_time = None
 
-    # parse since
+    # parse since (legacy, only used without an id cursor)
     try:
         if int(since_ms) > 0:
             last_load_time = datetime.utcfromtimestamp(int(since_ms) / 1000.0)
     except (ValueError, OSError):
         pass
 
-    # parse last_id
-    try:
-        if int(last_id) > 0:
-            min_id = int(last_id)
-    except ValueError:
-        pass
-
-    base_filter = or_(
-        and_(Message.sender_id == me, Message.receiver_id == other_user_id),
-        and_(Message.sender_id == other_user_id, Message.receiver_id == me),
+    query = (
+        Message.query
+        .filter(Message.conversation_key == _dm_conversation_key(me, other_user_id))
+        .filter(_not_hidden_for(me, "dm", Message.id))
     )
 
-    query = Message.query.filter(base_filter)
-
-    # ====== مهم: لو هذه أول مرة (since=0 و last_id=0) لا تجيب كل الرسائل ======
-    is_initial = (min_id == 0)
-    try:
-        is_initial = is_initial and (int(since_ms) <= 0)
-    except ValueError:
-        is_initial = True  # لو since غير صالح نعتبرها أول مرة بشكل آمن
-
-    if is_initial:
-        # آخر limit رسالة فقط (DESC ثم نعكسها للعرض ASC)
-        msgs_desc = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
-        msgs = list(reversed(msgs_desc))
+    # ====== مهم: بدون مؤشر لا نجيب كل الرسائل، فقط آخر limit رسالة ======
+    if not after_id and not before_id and last_load_time is not None:
+        query = query.filter(Message.timestamp > last_load_time)
+        rows = query.order_by(Message.timestamp.asc(), Message.id.asc()).limit(limit + 1).all()
+        msgs, has_more = rows[:limit], len(rows) > limit
     else:
-        # Prefer last_id to prevent duplicates
-        if min_id > 0:
-            query = query.filter(Message.id > min_id)
-        else:
-            query = query.filter(Message.timestamp > last_load_time)
+        msgs, has_more = _keyset_page(query, Message, limit, before_id=before_id, after_id=after_id, by_id=True)
 
-        msgs = query.order_by(Message.timestamp.asc(), Message.id.asc()).all()
+    # Serialize before marking read: the commit below would expire every row on the page
+    out = _serialize_messages(msgs, viewer_id=me)
 
-    # Mark unread messages (received by me) as read + emit read receipts to sender
+    # Mark every unread message from the other user as read (not just this page)
+    # + emit read receipts to sender
     try:
         now = datetime.now(timezone.utc).replace(tzinfo=None)
-        changed_ids_by_sender: dict[int, list[int]] = {}
-        changed = False
-        for m in msgs:
-            if m.receiver_id == me and not m.is_read:
-                m.is_read = True
-                # keep read_at synced
-                try:
-                    m.read_at = now
-                except Exception:
-                    pass
-                changed_ids_by_sender.setdefault(int(m.sender_id), []).append(int(m.id))
-                changed = True
-        if changed:
+        read_ids = _mark_dm_read(me, other_user_id, now)
+        if read_ids:
+            _summary_set_unread(me, "dm", other_user_id, 0)
             db.session.commit()
-            for sid, mids in changed_ids_by_sender.items():
-                socketio.emit(
-                    "message_status",
-                    {"type": "dm", "status": "read", "message_ids": mids, "at": _utc_iso(now)},
-                    room=f"user_{sid}",
-                )
+            read_set = set(read_ids)
+            for payload in out:
+                if int(payload["id"]) in read_set:
+                    payload["is_read"] = True
+                    payload["read_at"] = _utc_iso(now)
+            socketio.emit(
+                "message_status",
+                {"type": "dm", "status": "read", "message_ids": read_ids, "at": _utc_iso(now)},
+                room=f"user_{other_user_id}",
+            )
+            _emit_unread_update(f"user_{me}", "dm", other_user_id, unread=0)
     except SQLAlchemyError:
         db.session.rollback()
 
-    # Filter "delete for me" visibilities
-    try:
-        deleted_ids = {
-            int(r[0]) for r in db.session.query(MessageVisibility.message_id)
-            .filter_by(user_id=me, message_type="dm", is_deleted_for_me=True)
-            .all()
-        }
-    except Exception:
-        deleted_ids = set()
-
-    out = []
-    for m in msgs:
-        if int(m.id) in deleted_ids:
-            continue
-        # If deleted for everyone, render a placeholder
-        if bool(getattr(m, "deleted_for_all", False)):
-            m = m  # keep id/timestamp
-            placeholder = _serialize_message(m)
-            placeholder["content"] = "تم حذف هذه الرسالة"
-            placeholder["message_type"] = "deleted"
-            out.append(placeholder)
-        else:
-            out.append(_serialize_message(m))
+    for payload in out:
+        # If deleted for everyone, render a placeholder (keep id/timestamp)
+        if payload["deleted_for_all"]:
+            payload["content"] = "تم حذف هذه الرسالة"
+            payload["message_type"] = "deleted"
 
+    if use_envelope:
+        return jsonify({"ok": True, "messages": out, "has_more": has_more})
     return jsonify(out)
 
 
@@ -2501,12 +3875,21 @@ def api_message_delete_for_me(message_id: int):
         return jsonify({"ok": False, "error": "forbidden"}), 403
     try:
         row = MessageVisibility.query.filter_by(message_type="dm", message_id=message_id, user_id=me).first()
+        was_visible = not (row and row.is_deleted_for_me)
         if not row:
             row = MessageVisibility(message_type="dm", message_id=message_id, user_id=me, is_deleted_for_me=True)
             db.session.add(row)
         else:
             row.is_deleted_for_me = True
+        other_id = int(msg.receiver_id) if int(msg.sender_id) == int(me) else int(msg.sender_id)
+        _summary_refresh_last(me, "dm", other_id)
+        # A hidden unread message addressed to me no longer counts in the badge
+        unread = None
+        if was_visible and int(msg.receiver_id) == int(me) and int(msg.sender_id) != int(me) and not msg.is_read:
+            unread = _summary_drop_unread(me, "dm", other_id)
         db.session.commit()
+        if unread is not None:
+            _emit_unread_update(f"user_{me}", "dm", other_id, unread=unread)
     except Exception:
         db.session.rollback()
         return jsonify({"ok": False, "error": "db_error"}), 500
@@ -2526,6 +3909,7 @@ def api_message_delete_for_all(message_id: int):
         return jsonify({"ok": False, "error": "forbidden"}), 403
     try:
         msg.deleted_for_all = True
+        _summary_set_preview("dm", message_id, _message_preview(msg))
         db.session.commit()
         # Notify both sides
         socketio.emit("message_deleted", {"type": "dm", "message_id": int(message_id), "deleted_for_all": True}, room=f"user_{msg.receiver_id}")
@@ -2664,14 +4048,9 @@ def api_search_messages():
                 return jsonify({"ok": False, "error": "not_found"}), 404
             rows = (
                 Message.query
-                .filter(
-                    or_(
-                        and_(Message.sender_id == me, Message.receiver_id == conv_id),
-                        and_(Message.sender_id == conv_id, Message.receiver_id == me),
-                    )
-                )
+                .filter(Message.conversation_key == _dm_conversation_key(me, conv_id))
                 .filter(Message.content.ilike(like))
-                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .order_by(Message.id.desc())
                 .limit(50)
                 .all()
             )
@@ -2732,26 +4111,26 @@ def api_forward_message(message_id: int):
                 return jsonify({"ok": False, "error": "not_found"}), 404
             nm = Message(sender_id=me, receiver_id=target_id, content=msg.content, message_type=msg.message_type,
                          media_url=getattr(msg, "media_url", None), media_mime=getattr(msg, "media_mime", None),
-                         forwarded=True)
+                         forwarded=True, **_derivative_fields(msg))
             db.session.add(nm)
+            _media_url_ref(nm)
             db.session.commit()
-            _emit_direct_message(nm)
-            return jsonify({"ok": True, "message": _serialize_message(nm)})
+            return jsonify({"ok": True, "message": _emit_direct_message(nm)})
         if target_type == "group":
             member = GroupMember.query.filter_by(group_id=target_id, user_id=me, status="accepted").first()
             if not member:
                 return jsonify({"ok": False, "error": "forbidden"}), 403
             nm = GroupMessage(group_id=target_id, sender_id=me, content=msg.content, message_type=msg.message_type,
                              media_url=getattr(msg, "media_url", None), media_mime=getattr(msg, "media_mime", None),
-                             message_kind="user")
+                             message_kind="user", **_derivative_fields(msg))
             try:
                 nm.forwarded = True  # type: ignore
             except Exception:
                 pass
             db.session.add(nm)
+            _media_url_ref(nm)
             db.session.commit()
-            _emit_group_message(nm)
-            return jsonify({"ok": True, "message": _serialize_message(nm)})
+            return jsonify({"ok": True, "message": _emit_group_message(nm)})
         return jsonify({"ok": False, "error": "bad_type"}), 400
     except Exception:
         db.session.rollback()
@@ -2782,26 +4161,26 @@ def api_forward_group_message(message_id: int):
                 return jsonify({"ok": False, "error": "not_found"}), 404
             nm = Message(sender_id=me, receiver_id=target_id, content=msg.content, message_type=msg.message_type,
                          media_url=getattr(msg, "media_url", None), media_mime=getattr(msg, "media_mime", None),
-                         forwarded=True)
+                         forwarded=True, **_derivative_fields(msg))
             db.session.add(nm)
+            _media_url_ref(nm)
             db.session.commit()
-            _emit_direct_message(nm)
-            return jsonify({"ok": True, "message": _serialize_message(nm)})
+            return jsonify({"ok": True, "message": _emit_direct_message(nm)})
         if target_type == "group":
             member_dst = GroupMember.query.filter_by(group_id=target_id, user_id=me, status="accepted").first()
             if not member_dst:
                 return jsonify({"ok": False, "error": "forbidden"}), 403
             nm = GroupMessage(group_id=target_id, sender_id=me, content=msg.content, message_type=msg.message_type,
                              media_url=getattr(msg, "media_url", None), media_mime=getattr(msg, "media_mime", None),
-                             message_kind="user")
+                             message_kind="user", **_derivative_fields(msg))
             try:
                 nm.forwarded = True  # type: ignore
             except Exception:
                 pass
             db.session.add(nm)
+            _media_url_ref(nm)
             db.session.commit()
-            _emit_group_message(nm)
-            return jsonify({"ok": True, "message": _serialize_message(nm)})
+            return jsonify({"ok": True, "message": _emit_group_message(nm)})
         return jsonify({"ok": False, "error": "bad_type"}), 400
     except Exception:
         db.session.rollback()
@@ -2827,10 +4206,12 @@ def api_edit_message(message_id: int):
     try:
         msg.content = content
         msg.edited_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        _summary_set_preview("dm", message_id, _message_preview(msg))
         db.session.commit()
         # broadcast updated message
-        socketio.emit("message_edited", {"type": "dm", "message": _serialize_message(msg)}, room=f"user_{msg.sender_id}")
-        socketio.emit("message_edited", {"type": "dm", "message": _serialize_message(msg)}, room=f"user_{msg.receiver_id}")
+        payload = _serialize_message(msg)
+        socketio.emit("message_edited", {"type": "dm", "message": payload}, room=f"user_{msg.sender_id}")
+        socketio.emit("message_edited", {"type": "dm", "message": payload}, room=f"user_{msg.receiver_id}")
         return jsonify({"ok": True, "edited_at": _utc_iso(msg.edited_at)})
     except Exception:
         db.session.rollback()
@@ -2856,6 +4237,7 @@ def api_edit_group_message(message_id: int):
     try:
         msg.content = content
         msg.edited_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        _summary_set_preview("group", message_id, _message_preview(msg))
         db.session.commit()
         socketio.emit("message_edited", {"type": "group", "message": _serialize_message(msg)}, room=f"group_{msg.group_id}")
         return jsonify({"ok": True, "edited_at": _utc_iso(msg.edited_at)})
@@ -2893,29 +4275,31 @@ def api_group_members(group_id: int):
         return jsonify({"ok": False, "error": "db_error"}), 500
 
 
-@app.route("/send_message", methods=["POST"])
-def send_message():
-    if not login_required():
-        return jsonify({"error": "غير مسموح"}), 401
+def _send_direct_text(sender_id: int, receiver_id_raw, content, reply_to_raw=None,
+                      client_msg_id=None) -> tuple[dict, int]:
+    """Store and fan out a direct text message; returns (response body, HTTP status).
 
-    sender_id = session["user_id"]
-    receiver_id_raw = request.form.get("receiver_id", "").strip()
-    content = (request.form.get("content") or "").strip()
-    reply_to_raw = (request.form.get("reply_to_id") or "").strip()
+    Shared by the /send_message endpoint and the send_message Socket.IO event.
+    A repeated client_msg_id returns the stored message without re-running fan-out.
+    """
+    client_msg_id = _clean_client_msg_id(client_msg_id)
+    receiver_id_raw = str(receiver_id_raw or "").strip()
+    content = str(content or "").strip()
+    reply_to_raw = str(reply_to_raw or "").strip()
 
     if not receiver_id_raw or not content:
-        return jsonify({"error": "حقول ناقصة"}), 400
+        return {"error": "حقول ناقصة"}, 400
 
     if len(content) > 5000:
-        return jsonify({"error": "الرسالة طويلة جداً"}), 400
+        return {"error": "الرسالة طويلة جداً"}, 400
 
     try:
         receiver_id = int(receiver_id_raw)
     except ValueError:
-        return jsonify({"error": "معرف المستقبل غير صحيح"}), 400
+        return {"error": "معرف المستقبل غير صحيح"}, 400
 
     if not db.session.get(User, receiver_id):
-        return jsonify({"error": "المستخدم غير موجود"}), 404
+        return {"error": "المستخدم غير موجود"}, 404
 
     # Validate reply_to_id (optional) - must belong to the same conversation
     reply_to_id = None
@@ -2931,8 +4315,15 @@ def send_message():
         except Exception:
             reply_to_id = None
 
+    dup = _already_sent(Message, sender_id, client_msg_id)
+    if dup:
+        return dup
+
     try:
-        msg = Message(sender_id=sender_id, receiver_id=receiver_id, content=content, reply_to_id=reply_to_id)
+        msg = Message(
+            sender_id=sender_id, receiver_id=receiver_id, content=content,
+            reply_to_id=reply_to_id, client_msg_id=client_msg_id,
+        )
         db.session.add(msg)
         db.session.commit()
 
@@ -2948,19 +4339,44 @@ def send_message():
                 "tag": f"dm-{msg.id}",
                 "meta": {"type": "dm", "sender_id": sender_id, "receiver_id": receiver_id, "message_id": msg.id}
             }
-            if not is_conversation_muted(receiver_id, 'dm', sender_id):
-
-                send_push_to_user(receiver_id, payload)
+            enqueue_pushes(
+                _dm_push_recipients(receiver_id, sender_id), payload,
+                coalesce_key=f"dm-{sender_id}", coalesce_label=(sender.name if sender else None),
+            )
         except Exception:
-            pass
+            # The message is committed: leave the session usable for the emits below
+            db.session.rollback()
+            app.logger.exception("Queueing push notifications failed")
 
-        _emit_direct_message(msg)
+        payload = _emit_direct_message(msg)
 
-        return jsonify({"status": "ok", "message": _serialize_message(msg)})
+        return {"status": "ok", "message": payload}, 200
+    except IntegrityError:
+        db.session.rollback()
+        dup = _already_sent(Message, sender_id, client_msg_id)
+        if dup:
+            return dup
+        app.logger.exception("Send message error")
+        return {"error": "فشل إرسال الرسالة"}, 500
     except SQLAlchemyError:
         db.session.rollback()
         app.logger.exception("Send message error")
-        return jsonify({"error": "فشل إرسال الرسالة"}), 500
+        return {"error": "فشل إرسال الرسالة"}, 500
+
+
+@app.route("/send_message", methods=["POST"])
+def send_message():
+    if not login_required():
+        return jsonify({"error": "غير مسموح"}), 401
+
+    body, status = _send_direct_text(
+        session["user_id"],
+        request.form.get("receiver_id"),
+        request.form.get("content"),
+        request.form.get("reply_to_id"),
+        request.form.get("client_msg_id"),
+    )
+    return jsonify(body), status
 
 @app.route("/send_image", methods=["POST"])
 def send_image():
@@ -2994,19 +4410,13 @@ def send_image():
     if size > 8 * 1024 * 1024:
         return jsonify({"error": "حجم الصورة كبير"}), 400
 
-    from uuid import uuid4
     filename = secure_filename(f.filename or "image")
     ext = os.path.splitext(filename)[1].lower()
     if ext not in [".jpg", ".jpeg", ".png", ".gif", ".webp"]:
         # fallback based on mimetype
         ext = ".png" if "png" in mimetype else ".jpg"
 
-    new_name = f"{uuid4().hex}{ext}"
-    abs_path = os.path.join(app.config["MEDIA_IMAGE_FOLDER"], new_name)
-    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
-    f.save(abs_path)
-
-    media_url = url_for("serve_media", category="images", filename=new_name)
+    media_url, blob = store_media_upload(f, "images", ext)
     try:
         msg = Message(
             sender_id=sender_id,
@@ -3017,7 +4427,11 @@ def send_image():
             media_mime=mimetype,
         )
         db.session.add(msg)
+        _media_blob_ref(blob, msg)
+        has_derivatives = _attach_image_derivatives(msg, blob)
         db.session.commit()
+        if not has_derivatives:
+            _queue_image_derivatives(msg, blob)
 
         # Web Push notification
         try:
@@ -3031,17 +4445,21 @@ def send_image():
                 "tag": f"dm-{msg.id}",
                 "meta": {"type": "dm", "sender_id": sender_id, "receiver_id": receiver_id, "message_id": msg.id}
             }
-            if not is_conversation_muted(receiver_id, 'dm', sender_id):
-
-                send_push_to_user(receiver_id, payload)
+            enqueue_pushes(
+                _dm_push_recipients(receiver_id, sender_id), payload,
+                coalesce_key=f"dm-{sender_id}", coalesce_label=(sender.name if sender else None),
+            )
         except Exception:
-            pass
+            # The message is committed: leave the session usable for the emits below
+            db.session.rollback()
+            app.logger.exception("Queueing push notifications failed")
 
-        _emit_direct_message(msg)
+        payload = _emit_direct_message(msg)
 
-        return jsonify({"status": "ok", "message": _serialize_message(msg)})
+        return jsonify({"status": "ok", "message": payload})
     except SQLAlchemyError:
         db.session.rollback()
+        _media_discard_upload(blob)
         app.logger.exception("Send image error")
         return jsonify({"error": "فشل إرسال الصورة"}), 500
 
@@ -3078,18 +4496,12 @@ def send_audio():
     if size > 12 * 1024 * 1024:
         return jsonify({"error": "حجم الصوت كبير"}), 400
 
-    from uuid import uuid4
     filename = secure_filename(f.filename or "voice")
     ext = os.path.splitext(filename)[1].lower()
     if ext not in [".webm", ".ogg", ".wav", ".mp3", ".m4a", ".mp4"]:
         ext = ".webm"
 
-    new_name = f"{uuid4().hex}{ext}"
-    abs_path = os.path.join(app.config["MEDIA_AUDIO_FOLDER"], new_name)
-    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
-    f.save(abs_path)
-
-    media_url = url_for("serve_media", category="audio", filename=new_name)
+    media_url, blob = store_media_upload(f, "audio", ext)
     try:
         msg = Message(
             sender_id=sender_id,
@@ -3100,6 +4512,7 @@ def send_audio():
             media_mime=mimetype,
         )
         db.session.add(msg)
+        _media_blob_ref(blob, msg)
         db.session.commit()
 
         # Web Push notification
@@ -3114,17 +4527,21 @@ def send_audio():
                 "tag": f"dm-{msg.id}",
                 "meta": {"type": "dm", "sender_id": sender_id, "receiver_id": receiver_id, "message_id": msg.id}
             }
-            if not is_conversation_muted(receiver_id, 'dm', sender_id):
-
-                send_push_to_user(receiver_id, payload)
+            enqueue_pushes(
+                _dm_push_recipients(receiver_id, sender_id), payload,
+                coalesce_key=f"dm-{sender_id}", coalesce_label=(sender.name if sender else None),
+            )
         except Exception:
-            pass
+            # The message is committed: leave the session usable for the emits below
+            db.session.rollback()
+            app.logger.exception("Queueing push notifications failed")
 
-        _emit_direct_message(msg)
+        payload = _emit_direct_message(msg)
 
-        return jsonify({"status": "ok", "message": _serialize_message(msg)})
+        return jsonify({"status": "ok", "message": payload})
     except SQLAlchemyError:
         db.session.rollback()
+        _media_discard_upload(blob)
         app.logger.exception("Send audio error")
         return jsonify({"error": "فشل إرسال الصوت"}), 500
 
@@ -3159,7 +4576,6 @@ def send_file():
 
     mimetype = (f.mimetype or "application/octet-stream").lower()
 
-    from uuid import uuid4
     orig_name = secure_filename(f.filename or "file")
     ext = os.path.splitext(orig_name)[1].lower()
     if not ext:
@@ -3167,12 +4583,7 @@ def send_file():
         guess = mimetypes.guess_extension(mimetype) or ""
         ext = guess if len(guess) <= 10 else ""
 
-    new_name = f"{uuid4().hex}{ext}"
-    abs_path = os.path.join(app.config["MEDIA_FILE_FOLDER"], new_name)
-    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
-    f.save(abs_path)
-
-    media_url = url_for("serve_media", category="files", filename=new_name)
+    media_url, blob = store_media_upload(f, "files", ext)
     try:
         msg = Message(
             sender_id=sender_id,
@@ -3183,6 +4594,7 @@ def send_file():
             media_mime=mimetype,
         )
         db.session.add(msg)
+        _media_blob_ref(blob, msg)
         db.session.commit()
 
         # Web Push notification
@@ -3197,17 +4609,21 @@ def send_file():
                 "tag": f"dm-{msg.id}",
                 "meta": {"type": "dm", "sender_id": sender_id, "receiver_id": receiver_id, "message_id": msg.id}
             }
-            if not is_conversation_muted(receiver_id, 'dm', sender_id):
-
-                send_push_to_user(receiver_id, payload)
+            enqueue_pushes(
+                _dm_push_recipients(receiver_id, sender_id), payload,
+                coalesce_key=f"dm-{sender_id}", coalesce_label=(sender.name if sender else None),
+            )
         except Exception:
-            pass
+            # The message is committed: leave the session usable for the emits below
+            db.session.rollback()
+            app.logger.exception("Queueing push notifications failed")
 
-        _emit_direct_message(msg)
+        payload = _emit_direct_message(msg)
 
-        return jsonify({"status": "ok", "message": _serialize_message(msg)})
+        return jsonify({"status": "ok", "message": payload})
     except SQLAlchemyError:
         db.session.rollback()
+        _media_discard_upload(blob)
         app.logger.exception("Send file error")
         return jsonify({"error": "فشل إرسال الملف"}), 500
 
@@ -3397,6 +4813,346 @@ def ensure_media_folders():
     os.makedirs(upload_folder, exist_ok=True)
 
 
+def _media_folder(category: str) -> str:
+    if category == "images":
+        return app.config["MEDIA_IMAGE_FOLDER"]
+    if category == "audio":
+        return app.config["MEDIA_AUDIO_FOLDER"]
+    return app.config["MEDIA_FILE_FOLDER"]
+
+
+def store_media_upload(f, category: str, ext: str) -> tuple[str, dict]:
+    """Store an uploaded file under its SHA-256 digest; returns (media_url, blob info).
+
+    The upload stream is hashed before anything is written, so re-sending bytes that are
+    already stored costs no disk write. The caller passes the blob info to
+    _media_blob_ref() inside the transaction that stores the message, and to
+    _media_discard_upload() if that transaction rolls back.
+    """
+    h = hashlib.sha256()
+    size = 0
+    f.stream.seek(0)
+    for chunk in iter(lambda: f.stream.read(MEDIA_HASH_CHUNK_BYTES), b""):
+        h.update(chunk)
+        size += len(chunk)
+    digest = h.hexdigest()
+
+    blob = MediaBlob.query.filter_by(category=category, digest=digest).first()
+    filename = blob.filename if blob else f"{digest}{ext}"
+    folder = _media_folder(category)
+    path = os.path.join(folder, filename)
+    written = not os.path.exists(path)
+    if written:
+        _write_media_file(f, path)
+
+    info = {"category": category, "digest": digest, "filename": filename, "size": size, "upload": f, "written": written}
+    return url_for("serve_media", category=category, filename=filename), info
+
+
+def _write_media_file(f, path: str):
+    from uuid import uuid4
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    f.stream.seek(0)
+    # Write beside the target and rename, so a concurrent reader never sees half a file
+    tmp_path = f"{path}.{uuid4().hex}.part"
+    f.save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _split_media_url(media_url: Optional[str]):
+    """("images", "<digest>.png") for "/media/images/<digest>.png", else None."""
+    parts = (media_url or "").split("/")
+    if len(parts) != 4 or parts[0] or parts[1] != "media" or not parts[3]:
+        return None
+    return parts[2], parts[3]
+
+
+def _media_conversation(msg) -> tuple[str, str]:
+    if isinstance(msg, GroupMessage):
+        return "group", str(int(msg.group_id))
+    return "dm", _dm_conversation_key(msg.sender_id, msg.receiver_id)
+
+
+def _media_object_add(conn, category: str, filename: str, msg, size=None):
+    conv_type, conv_ref = _media_conversation(msg)
+    conn.execute(
+        _insert_ignoring_conflicts(conn, MediaObject.__table__).values(
+            category=category, filename=filename, conversation_type=conv_type, conversation_ref=conv_ref,
+            size=size, mime=msg.media_mime, created_at=datetime.now(timezone.utc).replace(tzinfo=None),
+        )
+    )
+
+
+def _media_blob_row(info: dict) -> dict:
+    return {
+        "category": info["category"], "digest": info["digest"], "filename": info["filename"], "size": info["size"],
+        "ref_count": 0, "created_at": datetime.now(timezone.utc).replace(tzinfo=None),
+    }
+
+
+def _media_blob_ref(info: dict, msg):
+    """Take one reference on a stored blob for msg and record its conversation (caller's transaction)."""
+    t = MediaBlob.__table__
+    conn = db.session.connection()
+    conn.execute(_insert_ignoring_conflicts(conn, t).values(**_media_blob_row(info)))
+    conn.execute(
+        t.update()
+        .where(t.c.category == info["category"], t.c.digest == info["digest"])
+        .values(ref_count=t.c.ref_count + 1)
+    )
+    # The blob row is locked now, so a delete that released it has already moved its
+    # file away (see _media_release): write it again rather than point at nothing.
+    path = os.path.join(_media_folder(info["category"]), info["filename"])
+    if info.get("upload") is not None and not os.path.exists(path):
+        _write_media_file(info["upload"], path)
+        info["written"] = True
+    _media_object_add(conn, info["category"], info["filename"], msg, size=info["size"])
+
+
+def _media_discard_upload(info: dict):
+    """After the message transaction rolled back: remove the file the upload wrote if no blob row uses it.
+
+    The check claims the (category, digest) row first, which waits for any other upload of
+    the same bytes still in flight; an upload that arrives later rewrites the file.
+    """
+    if not info.get("written"):
+        return
+    t = MediaBlob.__table__
+    try:
+        conn = db.session.connection()
+        claimed = conn.execute(_insert_ignoring_conflicts(conn, t).values(**_media_blob_row(info))).rowcount
+        if claimed:
+            conn.execute(t.delete().where(t.c.category == info["category"], t.c.digest == info["digest"]))
+            _remove_media_files([os.path.join(_media_folder(info["category"]), info["filename"])])
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+
+
+def _media_url_ref(msg):
+    """Take one more reference on the blob behind a forwarded message's media_url."""
+    key = _split_media_url(msg.media_url)
+    if not key:
+        return
+    t = MediaBlob.__table__
+    conn = db.session.connection()
+    conn.execute(
+        t.update()
+        .where(t.c.category == key[0], t.c.filename == key[1])
+        .values(ref_count=t.c.ref_count + 1)
+    )
+    size = conn.execute(db.select(t.c.size).where(t.c.category == key[0], t.c.filename == key[1])).scalar()
+    _media_object_add(conn, key[0], key[1], msg, size=size)
+
+
+_group_media_access = {}  # (user_id, group_id) -> (expires_at, allowed)
+_group_media_access_lock = threading.Lock()
+
+
+def _group_media_allowed(user_id: int, group_id: int) -> bool:
+    """Accepted, unblocked member of the group; answers are reused for MEDIA_ACCESS_CACHE_SECONDS."""
+    key = (int(user_id), int(group_id))
+    now = time.monotonic()
+    with _group_media_access_lock:
+        hit = _group_media_access.get(key)
+    if hit and hit[0] > now:
+        return hit[1]
+    blocked = db.select(GroupBlock.id).where(GroupBlock.group_id == key[1], GroupBlock.user_id == key[0])
+    allowed = db.session.execute(
+        db.select(GroupMember.id)
+        .where(GroupMember.group_id == key[1], GroupMember.user_id == key[0], GroupMember.status == "accepted")
+        .where(~blocked.exists())
+        .limit(1)
+    ).first() is not None
+    with _group_media_access_lock:
+        if len(_group_media_access) > 50000:
+            _group_media_access.clear()
+        _group_media_access[key] = (now + MEDIA_ACCESS_CACHE_SECONDS, allowed)
+    return allowed
+
+
+def _forget_group_media_access(group_id: int, user_id: Optional[int] = None):
+    """Drop cached answers after a membership change (this process; others expire by TTL)."""
+    with _group_media_access_lock:
+        if user_id is not None:
+            _group_media_access.pop((int(user_id), int(group_id)), None)
+            return
+        for key in [k for k in _group_media_access if k[1] == int(group_id)]:
+            _group_media_access.pop(key, None)
+
+
+def _media_release(url_counts) -> list[tuple[str, str]]:
+    """Drop references for deleted messages and move the files of unreferenced blobs aside.
+
+    url_counts: iterable of (media_url, number of messages removed). The move happens while
+    the blob rows are locked, so a concurrent upload of the same bytes finds the file gone
+    and writes it again. Returns (path, moved_path) pairs: pass them to _remove_media_files()
+    after the commit, or to _restore_media_files() after a rollback.
+    """
+    from uuid import uuid4
+    t = MediaBlob.__table__
+    conn = db.session.connection()
+    released = []
+    for media_url, n in url_counts:
+        key = _split_media_url(media_url)
+        if not key:
+            continue  # legacy /static uploads are not content-addressed
+        category, filename = key
+        conn.execute(
+            t.update()
+            .where(t.c.category == category, t.c.filename == filename)
+            .values(ref_count=t.c.ref_count - int(n))
+        )
+        released.append((category, filename))
+    paths = []
+    for category, filename in released:
+        unused = (t.c.category == category, t.c.filename == filename, t.c.ref_count <= 0)
+        derivatives = conn.execute(db.select(t.c.thumb_filename, t.c.preview_filename).where(*unused)).first()
+        if derivatives is None:
+            continue
+        conn.execute(t.delete().where(*unused))
+        for name in (filename, *derivatives):
+            if not name:
+                continue
+            path = os.path.join(_media_folder(category), name)
+            moved = f"{path}.{uuid4().hex}.del"
+            try:
+                os.replace(path, moved)
+            except OSError:
+                continue
+            paths.append((path, moved))
+    return paths
+
+
+def _remove_media_files(paths):
+    """Unlink media files; accepts plain paths or the (path, moved_path) pairs of _media_release."""
+    for path in paths:
+        if isinstance(path, tuple):
+            path = path[1]
+        try:
+            os.remove(path)
+        except OSError:
+            app.logger.warning("Could not remove media file %s", path)
+
+
+def _restore_media_files(moved):
+    """Undo _media_release's moves after its transaction rolled back."""
+    for path, moved_path in moved:
+        try:
+            os.replace(moved_path, path)
+        except OSError:
+            app.logger.warning("Could not restore media file %s", path)
+
+
+_DERIVATIVE_RE = re.compile(r"^(.+)\.(?:%s)\.(?:webp|jpg)$" % "|".join(s for s, _ in MEDIA_DERIVATIVE_SIZES))
+
+
+def _derivative_source(filename: str) -> str:
+    """Original filename for "<file>.s.webp" style derivatives (media_objects only lists originals)."""
+    m = _DERIVATIVE_RE.match(filename)
+    return m.group(1) if m else filename
+
+
+def _derivative_fields(msg) -> dict:
+    return {
+        "thumb_url": getattr(msg, "thumb_url", None),
+        "preview_url": getattr(msg, "preview_url", None),
+        "media_width": getattr(msg, "media_width", None),
+        "media_height": getattr(msg, "media_height", None),
+    }
+
+
+_thumb_pool = None
+_thumb_pool_lock = threading.Lock()
+
+
+def _thumb_executor():
+    global _thumb_pool
+    if _thumb_pool is None:
+        with _thumb_pool_lock:
+            if _thumb_pool is None:
+                # Not fork: the workers would inherit copies of this process's locks and threads.
+                # Workers only need media_derivatives (Pillow), so preload that instead of __main__.
+                ctx = multiprocessing.get_context("forkserver")
+                ctx.set_forkserver_preload(["media_derivatives"])
+                _thumb_pool = ProcessPoolExecutor(max_workers=MEDIA_THUMB_WORKERS, mp_context=ctx)
+    return _thumb_pool
+
+
+def _attach_image_derivatives(msg, info: dict) -> bool:
+    """Copy already rendered derivatives of this blob onto msg; False when they still need rendering."""
+    blob = MediaBlob.query.filter_by(category=info["category"], digest=info["digest"]).first()
+    if not blob or blob.width is None:
+        return False
+    if blob.thumb_filename:  # None for animated images, which keep showing the original
+        msg.thumb_url = f"/media/{blob.category}/{blob.thumb_filename}"
+        msg.preview_url = f"/media/{blob.category}/{blob.preview_filename}" if blob.preview_filename else None
+    msg.media_width, msg.media_height = blob.width, blob.height
+    return True
+
+
+def _queue_image_derivatives(msg, info: dict):
+    """Render derivatives for a committed image message off the request thread (process pool)."""
+    if not render_image_derivatives or not MEDIA_THUMB_WORKERS:
+        return
+    src_path = os.path.join(_media_folder(info["category"]), info["filename"])
+    try:
+        future = _thumb_executor().submit(render_image_derivatives, src_path, MEDIA_DERIVATIVE_SIZES)
+    except Exception:
+        app.logger.exception("Could not queue image derivatives")
+        return
+    future.add_done_callback(partial(_store_image_derivatives, msg.media_url, info))
+
+
+def _store_image_derivatives(media_url: str, info: dict, future):
+    """Pool callback: record rendered derivatives on the blob and on every message showing it.
+
+    Forwards made before rendering finished copy media_url without a thumb, so all DM and
+    group messages with this media_url and no thumb_url are filled in, then open chats told.
+    Animated images come back with dimensions only and keep showing the original.
+    """
+    try:
+        result = future.result()
+    except Exception:
+        app.logger.warning("Image derivatives failed for %s", info["filename"], exc_info=True)
+        return
+    category = info["category"]
+    thumb, preview = result.get("s"), result.get("m")
+    values = {"media_width": result["width"], "media_height": result["height"]}
+    if thumb:
+        values["thumb_url"] = f"/media/{category}/{thumb}"
+        values["preview_url"] = f"/media/{category}/{preview}" if preview else None
+    with app.app_context():
+        try:
+            MediaBlob.query.filter_by(category=category, digest=info["digest"]).update({
+                "thumb_filename": thumb,
+                "preview_filename": preview,
+                "width": result["width"],
+                "height": result["height"],
+            }, synchronize_session=False)
+            updated = []
+            for model in (Message, GroupMessage):
+                ids = [row.id for row in model.query.with_entities(model.id).filter(
+                    model.media_url == media_url, model.thumb_url.is_(None),
+                ).all()]
+                if ids:
+                    model.query.filter(model.id.in_(ids)).update(values, synchronize_session=False)
+                    updated.append((model, ids))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Recording image derivatives failed")
+            return
+        if not thumb:
+            return
+        try:
+            for model, ids in updated:
+                for msg in model.query.filter(model.id.in_(ids)).all():
+                    _emit_message_media(msg)
+        except Exception:
+            app.logger.exception("Announcing image derivatives failed")
+
+
 def init_storage_and_db():
     """Initialize DB/tables/columns when running via `flask run` or `python app.py`."""
     with app.app_context():
@@ -3418,11 +5174,77 @@ except Exception:
 
 
 
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _media_response(category: str, filename: str):
+    """Response for a stored media file, either offloaded to the proxy or sent by werkzeug."""
+    as_attachment = category == "files"
+    folder = _media_folder(category)
+    offload = app.config.get("MEDIA_OFFLOAD")
+    if offload in ("x-accel", "x-sendfile"):
+        path = safe_join(os.path.join(app.root_path, folder), filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        resp = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        if offload == "x-accel":
+            prefix = app.config["MEDIA_ACCEL_PREFIX"].rstrip("/")
+            resp.headers["X-Accel-Redirect"] = quote(f"{prefix}/{category}/{filename}")
+        else:
+            resp.headers["X-Sendfile"] = path
+        if as_attachment:
+            # Same header send_file builds (quoted when the name needs it)
+            resp.headers.set("Content-Disposition", "attachment", filename=os.path.basename(filename))
+        return resp
+
+    # Content-addressed files get their digest as a strong ETag, identical on every worker
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    resp = send_from_directory(
+        folder, filename, as_attachment=as_attachment,
+        etag=stem if _DIGEST_RE.match(stem) else True,
+    )
+    # Tell media elements they may seek with Range requests instead of re-downloading
+    resp.headers["Accept-Ranges"] = "bytes"
+    return resp
+
+
+def _serve_signed_media(category: str, filename: str):
+    """Serve a media URL signed by _signed_media_url for the session user; None if not valid.
+
+    Pure CPU (HMAC over path, user id and expiry): no user, message or membership query.
+    """
+    uid, expires, sig = request.args.get("u"), request.args.get("e"), request.args.get("s")
+    if not (uid and expires and sig):
+        return None
+    try:
+        uid, expires = int(uid), int(expires)
+    except ValueError:
+        return None
+    remaining = expires - int(time.time())
+    if remaining <= 0 or session.get("user_id") != uid:
+        return None
+    expected = _media_signature(f"/media/{category}/{filename}", uid, expires)
+    if not hmac.compare_digest(expected, sig):
+        return None
+    resp = _media_response(category, filename)
+    # Content-addressed files never change under a URL: let the browser keep them until expiry
+    resp.cache_control.private = True
+    resp.cache_control.public = False
+    resp.cache_control.no_cache = None
+    resp.cache_control.max_age = remaining
+    resp.cache_control.immutable = True
+    return resp
+
+
 @app.route("/media/<path:category>/<path:filename>")
 def serve_media(category, filename):
     """Serve protected media files only to authorized users."""
     if not login_required():
         return jsonify({"ok": False, "error": "unauthorized"}), 401
+    if category in ("images", "audio", "files"):
+        signed = _serve_signed_media(category, filename)
+        if signed is not None:
+            return signed
     me = current_user()
     if not me:
         return jsonify({"ok": False, "error": "unauthorized"}), 401
@@ -3432,30 +5254,18 @@ def serve_media(category, filename):
     if category not in ("images", "audio", "files"):
         abort(404)
 
-    # Rebuild the media_url exactly as stored
-    media_url = f"/media/{category}/{filename}"
-
-    # Direct messages authorization
-    dm = Message.query.filter(Message.media_url == media_url).first()
-    if dm:
-        if dm.sender_id != me.id and dm.receiver_id != me.id:
-            return jsonify({"ok": False, "error": "forbidden"}), 403
-        folder = app.config["MEDIA_IMAGE_FOLDER"] if category == "images" else app.config["MEDIA_AUDIO_FOLDER"] if category == "audio" else app.config["MEDIA_FILE_FOLDER"]
-        return send_from_directory(folder, filename, as_attachment=(category == "files"))
-
-    # Group messages authorization
-    gm = GroupMessage.query.filter(GroupMessage.media_url == media_url).first()
-    if gm:
-        # Must be accepted member and not blocked
-        m = GroupMember.query.filter_by(group_id=gm.group_id, user_id=me.id, status="accepted").first()
-        if not m:
-            return jsonify({"ok": False, "error": "forbidden"}), 403
-        if GroupBlock.query.filter_by(group_id=gm.group_id, user_id=me.id).first():
-            return jsonify({"ok": False, "error": "forbidden"}), 403
-        folder = app.config["MEDIA_IMAGE_FOLDER"] if category == "images" else app.config["MEDIA_AUDIO_FOLDER"] if category == "audio" else app.config["MEDIA_FILE_FOLDER"]
-        return send_from_directory(folder, filename, as_attachment=(category == "files"))
-
-    abort(404)
+    objs = MediaObject.query.filter_by(category=category, filename=_derivative_source(filename)).all()
+    if not objs:
+        abort(404)
+    # Content-addressed files can be shared by several conversations; any visible one will do
+    for obj in objs:
+        if obj.conversation_type == "dm":
+            allowed = str(me.id) in obj.conversation_ref.split(":")
+        else:
+            allowed = _group_media_allowed(me.id, int(obj.conversation_ref))
+        if allowed:
+            return _media_response(category, filename)
+    return jsonify({"ok": False, "error": "forbidden"}), 403
 
 
 @app.route("/api/unread_counts")
@@ -3468,79 +5278,9 @@ def api_unread_counts():
     if not me:
         return jsonify({"ok": False}), 200
 
-    uid = me.id
-
-    # Unread counts for direct messages grouped by sender
-    user_counts = {}
-    try:
-        rows = (
-            db.session.query(Message.sender_id, func.count(Message.id))
-            .filter(Message.receiver_id == uid, Message.is_read == False)  # noqa: E712
-            .group_by(Message.sender_id)
-            .all()
-        )
-        user_counts = {int(sid): int(cnt) for sid, cnt in rows}
-    except Exception:
-        user_counts = {}
-
-    # Pending group invites
-    invites_count = 0
-    try:
-        invites_count = GroupMember.query.filter_by(user_id=uid, status="pending").count()
-    except Exception:
-        invites_count = 0
-
-    # Unread counts for groups: messages newer than last_read_at
-    group_counts = {}
-    last_ts_groups = {}
-    try:
-        group_counts, last_ts_groups = _load_group_activity(uid)
-    except Exception:
-        group_counts = {}
-        last_ts_groups = {}
-
-    # Latest interaction timestamp per conversation (to allow live reordering in sidebar)
-    last_ts_users = {}
-    try:
-        other_id = case(
-            (Message.sender_id == uid, Message.receiver_id),
-            else_=Message.sender_id,
-        )
-        rows = (
-            db.session.query(other_id.label("other_id"), func.max(Message.timestamp).label("mx"))
-            .filter(or_(Message.sender_id == uid, Message.receiver_id == uid))
-            .group_by(other_id)
-            .all()
-        )
-        for oid, mx in rows:
-            if oid is None or mx is None:
-                continue
-            last_ts_users[int(oid)] = int(mx.timestamp() * 1000)
-    except Exception:
-        last_ts_users = {}
-
-    return jsonify({
-        "ok": True,
-        "users": user_counts,
-        "groups": group_counts,
-        "invites": invites_count,
-        "last_ts": {"users": last_ts_users, "groups": last_ts_groups},
-    }), 200
+    return jsonify(compute_unread_counts_for_user(me.id)), 200
 
 def compute_unread_counts_for_user(uid: int):
-    # Unread counts for direct messages grouped by sender
-    user_counts = {}
-    try:
-        rows = (
-            db.session.query(Message.sender_id, func.count(Message.id))
-            .filter(Message.receiver_id == uid, Message.is_read == False)  # noqa: E712
-            .group_by(Message.sender_id)
-            .all()
-        )
-        user_counts = {int(sid): int(cnt) for sid, cnt in rows}
-    except Exception:
-        user_counts = {}
-
     # Pending group invites
     invites_count = 0
     try:
@@ -3548,34 +5288,12 @@ def compute_unread_counts_for_user(uid: int):
     except Exception:
         invites_count = 0
 
-    # Unread counts for groups: messages newer than last_read_at
-    group_counts = {}
-    last_ts_groups = {}
-    try:
-        group_counts, last_ts_groups = _load_group_activity(uid)
-    except Exception:
-        group_counts = {}
-        last_ts_groups = {}
-
-    # Latest interaction timestamp per conversation (for sidebar reorder)
-    last_ts_users = {}
+    # Unread counts + latest interaction per conversation (for badges and sidebar reorder),
+    # both straight from conversation_summary
     try:
-        other_id = case(
-            (Message.sender_id == uid, Message.receiver_id),
-            else_=Message.sender_id,
-        )
-        rows = (
-            db.session.query(other_id.label("other_id"), func.max(Message.timestamp).label("mx"))
-            .filter(or_(Message.sender_id == uid, Message.receiver_id == uid))
-            .group_by(other_id)
-            .all()
-        )
-        for oid, mx in rows:
-            if oid is None or mx is None:
-                continue
-            last_ts_users[int(oid)] = int(mx.timestamp() * 1000)
+        user_counts, group_counts, last_ts_users, last_ts_groups = _load_conversation_activity(uid)
     except Exception:
-        last_ts_users = {}
+        user_counts, group_counts, last_ts_users, last_ts_groups = {}, {}, {}, {}
 
     return {
         "ok": True,
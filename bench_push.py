@@ -0,0 +1,100 @@
+"""Benchmark Web Push fan-out against a local stand-in push service.
+
+Sends the same notification to N fake devices twice: once with a new HTTP
+connection per send (pywebpush's default), once through the pooled keep-alive
+sessions used by send_push_to_user_detail. Both runs use PUSH_WORKERS threads,
+like the push queue does.
+
+    python bench_push.py --devices 30 --rounds 5
+
+The stand-in service is plain HTTP on localhost, so the pooled run only saves
+TCP setup here; against real push services it also skips a TLS handshake per send.
+"""
+import argparse
+import base64
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+import app as chat_app
+
+
+class _PushService(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    delay = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.delay:
+            time.sleep(self.delay)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("utf-8")
+
+
+def _fake_subscription(base_url: str, i: int) -> dict:
+    key = ec.generate_private_key(ec.SECP256R1())
+    p256dh = key.public_key().public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+    return {"endpoint": f"{base_url}/push/{i}", "keys": {"p256dh": _b64url(p256dh), "auth": _b64url(os.urandom(16))}}
+
+
+def _run(subs, rounds: int, pooled: bool, priv: str) -> float:
+    data = '{"title": "bench", "body": "hello"}'
+
+    def send(sub):
+        chat_app.webpush(
+            subscription_info=sub,
+            data=data,
+            headers=chat_app._vapid_headers(sub["endpoint"], priv),
+            requests_session=chat_app._push_session(sub["endpoint"]) if pooled else None,
+            timeout=(chat_app.PUSH_HTTP_CONNECT_TIMEOUT, chat_app.PUSH_HTTP_READ_TIMEOUT),
+        )
+
+    with ThreadPoolExecutor(max_workers=chat_app.PUSH_WORKERS) as pool:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            list(pool.map(send, subs))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=30, help="subscriptions per fan-out (group size)")
+    parser.add_argument("--rounds", type=int, default=5, help="messages sent to the whole group")
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="server-side processing time per push")
+    args = parser.parse_args()
+
+    if not chat_app.webpush:
+        raise SystemExit("pywebpush is not installed")
+    _PushService.delay = args.delay_ms / 1000.0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _PushService)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with chat_app.app.app_context():
+        _, priv = chat_app.ensure_vapid_keys()
+    subs = [_fake_subscription(base_url, i) for i in range(args.devices)]
+    total = args.devices * args.rounds
+
+    for label, pooled in (("new connection per send", False), ("pooled keep-alive", True)):
+        elapsed = _run(subs, args.rounds, pooled, priv)
+        print(f"{label:26s} {total} pushes in {elapsed:.3f}s  ({total / elapsed:.0f}/s)")
+    for origin, stats in chat_app.push_http_stats().items():
+        print(f"{origin}: {stats}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""Image thumbnail/preview rendering for the app's thumbnail process pool.
+
+Kept out of app.py so pool workers (started with forkserver, not fork) only import
+Pillow here instead of re-running the app's import-time setup.
+"""
+import os
+
+from PIL import Image, ImageOps, features as pil_features
+
+
+def render_image_derivatives(src_path: str, sizes) -> dict:
+    """Write downscaled copies next to src_path.
+
+    sizes: (suffix, longest edge in px) pairs. WebP when Pillow was built with it, JPEG
+    otherwise. Returns the original dimensions and the derivative filenames keyed by
+    suffix; animated images only get their dimensions, since a still thumb would lose
+    the animation.
+    """
+    webp = pil_features.check("webp")
+    fmt, ext = ("WEBP", "webp") if webp else ("JPEG", "jpg")
+    with Image.open(src_path) as im:
+        if im.format == "GIF" or getattr(im, "is_animated", False):
+            return {"width": im.width, "height": im.height}
+        im = ImageOps.exif_transpose(im)
+        out = {"width": im.width, "height": im.height}
+        for suffix, edge in sizes:
+            small = im.copy()
+            small.thumbnail((edge, edge))
+            if small.mode not in (("RGB", "RGBA") if webp else ("RGB",)):
+                small = small.convert("RGBA" if webp and "A" in small.mode else "RGB")
+            name = f"{os.path.basename(src_path)}.{suffix}.{ext}"
+            path = os.path.join(os.path.dirname(src_path), name)
+            small.save(f"{path}.part", fmt, quality=80)
+            os.replace(f"{path}.part", path)
+            out[suffix] = name
+    return out
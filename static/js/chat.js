@@ -65,6 +65,9 @@
   let currentGroupId = null;
   let lastMessageTimestamp = 0;
   let lastMessageId = 0;
+  let oldestMessageId = 0;
+  let hasMoreOlder = false;
+  let loadingOlder = false;
   let notificationSound = null;
   let currentUserId = null;
   let displayedMessages = new Set();
@@ -74,6 +77,7 @@
   let currentGroupIsOwner = false;
   let socket = null;
   let socketConnected = false;
+  let socketEverConnected = false;
   let onlineUsers = new Set();
   let typingTimer = null;
   let typingActive = false;
@@ -84,11 +88,19 @@
   let badgePollIntervalId = null;
   let badgePollTimeoutId = null;
   let badgeRefreshEnabled = false;
+  let conversationsCursor = null;
+  let conversationsDone = false;
+  let conversationsLoading = false;
 
   const MESSAGE_DOM_LIMIT = 100;
   const MESSAGE_PAGE_LIMIT = 50;
-  const BADGE_POLL_INTERVAL_MS = 15000;
+  const MESSAGE_PAGE_MAX = 200;
+  const BADGE_POLL_INTERVAL_MS = 2000; // first retry while disconnected, doubled up to the max
+  const BADGE_POLL_MAX_MS = 60000;
   const BADGE_POLL_DELAY_MS = 3000;
+  const CONVERSATION_PAGE_LIMIT = 30;
+  const SEND_ACK_TIMEOUT_MS = 10000;
+  let badgePollDelayMs = BADGE_POLL_INTERVAL_MS;
 
   // ====== DOM Elements ======
   const messagesDiv = document.getElementById("messages");
@@ -631,6 +643,128 @@
     if (li) {
       li.setAttribute("data-last-ms", String(ts));
       scheduleReorderConversations();
+    } else {
+      // Not on a loaded sidebar page yet: fetch just this entry
+      ensureConversationItem(kind, id);
+    }
+  }
+
+  // ====== Sidebar pages (/api/conversations) ======
+  function setConversationBadge(li, count) {
+    let badge = li.querySelector(".badge-unread");
+    if (!badge) {
+      badge = document.createElement("span");
+      badge.className = "badge-unread";
+      li.appendChild(badge);
+    }
+    const c = Number(count || 0);
+    li.setAttribute("data-unread", String(c));
+    if (c > 0) {
+      badge.textContent = c > 99 ? "99+" : String(c);
+      badge.style.display = "inline-flex";
+    } else {
+      badge.style.display = "none";
+    }
+  }
+
+  function buildConversationItem(c) {
+    const li = document.createElement("li");
+    li.className = "user-item";
+    const info = document.createElement("div");
+    info.className = "user-info";
+    const nameEl = document.createElement("div");
+    nameEl.className = "user-name";
+    nameEl.textContent = c.name || "";
+    const statusEl = document.createElement("div");
+    statusEl.className = "user-status";
+    if (c.type === "group") {
+      li.setAttribute("data-group-id", String(c.id));
+      li.setAttribute("data-owner-id", String(c.owner_id || ""));
+      li.setAttribute("data-is-owner", c.is_owner ? "1" : "0");
+      const avatar = document.createElement("div");
+      avatar.className = "avatar-circle group";
+      avatar.innerHTML = `<i class="bi bi-people"></i>`;
+      li.appendChild(avatar);
+      statusEl.textContent = "مجموعة";
+    } else {
+      li.setAttribute("data-user-id", String(c.id));
+      li.setAttribute("data-avatar", c.avatar || "");
+      const img = document.createElement("img");
+      img.src = c.avatar || "";
+      img.alt = c.name || "";
+      li.appendChild(img);
+      statusEl.textContent = c.phone_number || "";
+    }
+    li.setAttribute("data-name", c.name || "");
+    info.appendChild(nameEl);
+    info.appendChild(statusEl);
+    li.appendChild(info);
+    const badge = document.createElement("span");
+    badge.className = "badge-unread";
+    badge.style.display = "none";
+    li.appendChild(badge);
+    if ((c.type === "group" && String(c.id) === String(currentGroupId)) ||
+        (c.type !== "group" && String(c.id) === String(currentReceiverId))) {
+      li.classList.add("active");
+    }
+    return li;
+  }
+
+  function upsertConversationItem(c) {
+    const ul = document.getElementById("users-list");
+    if (!ul || !c) return null;
+    const sel = c.type === "group" ? `li.user-item[data-group-id="${c.id}"]` : `li.user-item[data-user-id="${c.id}"]`;
+    let li = ul.querySelector(sel);
+    if (!li) {
+      li = buildConversationItem(c);
+      ul.appendChild(li);
+    }
+    const known = Number(li.getAttribute("data-last-ms") || 0);
+    li.setAttribute("data-last-ms", String(Math.max(known, Number(c.last_ms || 0))));
+    li.setAttribute("data-pinned-rank", c.pinned_rank === null || c.pinned_rank === undefined ? "" : String(c.pinned_rank));
+    li.setAttribute("data-archived", c.archived ? "1" : "0");
+    li.setAttribute("data-muted-until", c.muted_until || "");
+    setConversationBadge(li, c.unread);
+    return li;
+  }
+
+  async function loadConversations() {
+    if (conversationsLoading || conversationsDone) return;
+    conversationsLoading = true;
+    try {
+      const params = new URLSearchParams({ limit: String(CONVERSATION_PAGE_LIMIT) });
+      if (conversationsCursor) params.set("cursor", conversationsCursor);
+      const res = await fetch(`/api/conversations?${params.toString()}`, { cache: "no-store" });
+      if (!res.ok) return;
+      const data = await res.json();
+      if (!data || !data.ok) return;
+      (data.conversations || []).forEach(upsertConversationItem);
+      conversationsCursor = data.next_cursor || null;
+      conversationsDone = !conversationsCursor;
+      reorderConversationList();
+    } catch (_) {
+    } finally {
+      conversationsLoading = false;
+    }
+  }
+
+  const pendingConversationItems = new Set();
+  async function ensureConversationItem(kind, id) {
+    const type = kind === "group" ? "group" : "dm";
+    const key = `${type}:${id}`;
+    if (pendingConversationItems.has(key)) return;
+    pendingConversationItems.add(key);
+    try {
+      const res = await fetch(`/api/conversations/${type}/${id}`, { cache: "no-store" });
+      if (!res.ok) return;
+      const data = await res.json();
+      if (data && data.ok && data.conversation) {
+        upsertConversationItem(data.conversation);
+        scheduleReorderConversations();
+      }
+    } catch (_) {
+    } finally {
+      pendingConversationItems.delete(key);
     }
   }
 
@@ -740,7 +874,13 @@
 
     if (type === "image" && mediaUrl) {
       const safeUrl = escapeHtml(mediaUrl);
-      return `${senderLine}${quoteHtml}<div class="media-wrap"><a href="${safeUrl}" target="_blank" rel="noopener"><img class="msg-image" src="${safeUrl}" alt="image" loading="lazy"></a></div>${timeLine}`;
+      // Inline a small derivative (kilobytes); the link still opens the original
+      const src = escapeHtml(msg.thumb_url || mediaUrl);
+      const srcset = (msg.thumb_url && msg.preview_url)
+        ? ` srcset="${src} 1x, ${escapeHtml(msg.preview_url)} 2x"` : "";
+      const dims = (msg.media_width && msg.media_height)
+        ? ` width="${Number(msg.media_width)}" height="${Number(msg.media_height)}"` : "";
+      return `${senderLine}${quoteHtml}<div class="media-wrap"><a href="${safeUrl}" target="_blank" rel="noopener"><img class="msg-image" src="${src}"${srcset}${dims} alt="image" loading="lazy" decoding="async"></a></div>${timeLine}`;
     }
     if (type === "audio" && mediaUrl) {
       const safeUrl = escapeHtml(mediaUrl);
@@ -760,12 +900,20 @@
   }
 
   function pruneOldMessages() {
+    // Don't pull history out from under a user who scrolled back to read it.
+    if (loadingOlder) return;
+    const nearBottom = (messagesDiv.scrollHeight - messagesDiv.scrollTop - messagesDiv.clientHeight) < 120;
+    if (!nearBottom) return;
     const messages = messagesDiv.querySelectorAll(".message");
     if (messages.length <= MESSAGE_DOM_LIMIT) return;
     const excess = messages.length - MESSAGE_DOM_LIMIT;
     for (let i = 0; i < excess; i += 1) {
+      displayedMessages.delete(String(messages[i].dataset.msgId));
       messages[i].remove();
     }
+    // Pruned messages can be fetched again by scrolling up
+    oldestMessageId = Number(messages[excess].dataset.msgId) || oldestMessageId;
+    hasMoreOlder = true;
   }
 
   // ====== Message actions (reply / edit / delete / star / forward) ======
@@ -1430,17 +1578,28 @@
   // ====== API - Load Messages ======
   async function loadMessages({ allowSound = false, forceScrollBottom = false, updateSidebar = true } = {}) {
     if (!currentReceiverId && !currentGroupId) return;
-    const isInitial = lastMessageId === 0 && lastMessageTimestamp === 0;
-    const limitParam = isInitial ? `&limit=${MESSAGE_PAGE_LIMIT}` : "";
+    const isInitial = lastMessageId === 0;
+    // Initial load: latest page (before_id=0). Afterwards: catch up after the newest message we have.
+    const cursorParams = isInitial
+      ? `before_id=0&limit=${MESSAGE_PAGE_LIMIT}`
+      : `after_id=${lastMessageId}&limit=${MESSAGE_PAGE_MAX}`;
     const url = currentGroupId
-      ? `/get_group_messages/${currentGroupId}?last_id=${lastMessageId}${limitParam}`
-      : `/get_messages/${currentReceiverId}?since=${lastMessageTimestamp}&last_id=${lastMessageId}${limitParam}`;
+      ? `/get_group_messages/${currentGroupId}?${cursorParams}`
+      : `/get_messages/${currentReceiverId}?${cursorParams}`;
+    let moreNewer = false;
     try {
       if (isInitial) showMessageSkeleton();
       console.time("loadMessages");
       const res = await fetch(url, { cache: "no-store" });
-      const data = await res.json();
-      if (!Array.isArray(data)) return;
+      const body = await res.json();
+      const data = body && Array.isArray(body.messages) ? body.messages : null;
+      if (!data) return;
+      if (isInitial) {
+        hasMoreOlder = Boolean(body.has_more);
+        oldestMessageId = data.length ? Number(data[0].id) : 0;
+      } else {
+        moreNewer = Boolean(body.has_more);
+      }
       if (data.length > 0) hideEmptyState();
 
       let hasNewIncoming = false, newAdded = false;
@@ -1493,6 +1652,59 @@
       hideMessageSkeleton();
       console.timeEnd("loadMessages");
     }
+    // Long gap (e.g. reconnect): keep catching up page by page
+    if (moreNewer) await loadMessages({ allowSound, forceScrollBottom, updateSidebar });
+  }
+
+  // ====== API - Load older history (scroll back) ======
+  async function loadOlderMessages() {
+    if (loadingOlder || !hasMoreOlder || !oldestMessageId) return;
+    if (!currentReceiverId && !currentGroupId) return;
+    const convKey = currentGroupId ? `g${currentGroupId}` : `u${currentReceiverId}`;
+    const params = `before_id=${oldestMessageId}&limit=${MESSAGE_PAGE_LIMIT}`;
+    const url = currentGroupId
+      ? `/get_group_messages/${currentGroupId}?${params}`
+      : `/get_messages/${currentReceiverId}?${params}`;
+    loadingOlder = true;
+    try {
+      const res = await fetch(url, { cache: "no-store" });
+      const body = await res.json();
+      const data = body && Array.isArray(body.messages) ? body.messages : null;
+      // Conversation switched while loading
+      if (!data || convKey !== (currentGroupId ? `g${currentGroupId}` : `u${currentReceiverId}`)) return;
+      hasMoreOlder = Boolean(body.has_more);
+      if (!data.length) return;
+      oldestMessageId = Number(data[0].id);
+
+      // Build the older batch with its own date separators, then prepend it
+      const fragment = document.createDocumentFragment();
+      const savedLastDate = lastDate;
+      lastDate = null;
+      let batchLastDate = null;
+      for (const msg of data) {
+        const key = String(msg.id);
+        if (displayedMessages.has(key)) continue;
+        appendMessageToFragment(msg, fragment);
+        displayedMessages.add(key);
+        batchLastDate = lastDate;
+      }
+      lastDate = savedLastDate;
+      if (!fragment.childNodes.length) return;
+
+      const prevHeight = messagesDiv.scrollHeight;
+      const firstOld = messagesDiv.querySelector(".date-separator, .message");
+      messagesDiv.insertBefore(fragment, firstOld);
+      // Drop the now-duplicated separator if the batch ends on the same day
+      if (firstOld && firstOld.classList.contains("date-separator") && batchLastDate) {
+        const firstMsg = firstOld.nextElementSibling;
+        const firstMsgData = firstMsg ? getMsgFromCache(firstMsg.dataset.msgType, firstMsg.dataset.msgId) : null;
+        if (firstMsgData && localDateKey(firstMsgData.timestamp_ms || 0) === batchLastDate) firstOld.remove();
+      }
+      messagesDiv.scrollTop += messagesDiv.scrollHeight - prevHeight;
+    } catch (_) {
+    } finally {
+      loadingOlder = false;
+    }
   }
 
   // ====== Sidebar Badges Refresh ======
@@ -1524,38 +1736,22 @@
       const ucounts = data.users || {};
       document.querySelectorAll('li.user-item[data-user-id]').forEach((li) => {
         const id = Number(li.getAttribute("data-user-id") || 0);
-        const c = Number(ucounts[id] || 0);
-        let badge = li.querySelector(".badge-unread");
-        if (!badge) {
-          badge = document.createElement("span");
-          badge.className = "badge-unread";
-          li.appendChild(badge);
-        }
-        if (c > 0) {
-          badge.textContent = c > 99 ? "99+" : String(c);
-          badge.style.display = "inline-flex";
-        } else {
-          badge.style.display = "none";
-        }
+        setConversationBadge(li, ucounts[id]);
       });
 
       // Group Messages
       const gcounts = data.groups || {};
       document.querySelectorAll('li.user-item[data-group-id]').forEach((li) => {
         const gid = Number(li.getAttribute("data-group-id") || 0);
-        const c = Number(gcounts[gid] || 0);
-        let badge = li.querySelector(".badge-unread");
-        if (!badge) {
-          badge = document.createElement("span");
-          badge.className = "badge-unread";
-          li.appendChild(badge);
-        }
-        if (c > 0) {
-          badge.textContent = c > 99 ? "99+" : String(c);
-          badge.style.display = "inline-flex";
-        } else {
-          badge.style.display = "none";
-        }
+        setConversationBadge(li, gcounts[gid]);
+      });
+
+      // Unread conversations beyond the loaded sidebar pages
+      Object.keys(ucounts).forEach((id) => {
+        if (Number(ucounts[id]) > 0 && !document.querySelector(`li.user-item[data-user-id="${id}"]`)) ensureConversationItem("user", id);
+      });
+      Object.keys(gcounts).forEach((gid) => {
+        if (Number(gcounts[gid]) > 0 && !document.querySelector(`li.user-item[data-group-id="${gid}"]`)) ensureConversationItem("group", gid);
       });
 
       // === Update ordering by latest message timestamp (users + groups) ===
@@ -1578,17 +1774,50 @@
     } catch (_) {}
   }
 
+  // Badges are pushed as unread_delta events; polling only runs while the socket is down,
+  // backing off exponentially until it reconnects.
   function startBadgePolling() {
-    if (badgePollIntervalId) return;
-    badgePollIntervalId = setInterval(() => refreshSidebarBadges(), BADGE_POLL_INTERVAL_MS);
+    if (badgePollIntervalId || socketConnected) return;
+    const tick = () => {
+      badgePollIntervalId = setTimeout(async () => {
+        await refreshSidebarBadges();
+        if (socketConnected || document.hidden) { badgePollIntervalId = null; return; }
+        badgePollDelayMs = Math.min(badgePollDelayMs * 2, BADGE_POLL_MAX_MS);
+        tick();
+      }, badgePollDelayMs);
+    };
+    tick();
   }
 
   function stopBadgePolling() {
+    badgePollDelayMs = BADGE_POLL_INTERVAL_MS;
     if (!badgePollIntervalId) return;
-    clearInterval(badgePollIntervalId);
+    clearTimeout(badgePollIntervalId);
     badgePollIntervalId = null;
   }
 
+  function applyUnreadDelta(data) {
+    if (!data || !data.id) return;
+    const kind = data.type === "group" ? "group" : "user";
+    const li = kind === "group"
+      ? document.querySelector(`li.user-item[data-group-id="${data.id}"]`)
+      : document.querySelector(`li.user-item[data-user-id="${data.id}"]`);
+    if (!li) {
+      // Not loaded yet: the fetched entry carries the server's unread count
+      ensureConversationItem(kind, data.id);
+      return;
+    }
+    const isActive = kind === "group"
+      ? String(data.id) === String(currentGroupId)
+      : String(data.id) === String(currentReceiverId);
+    if (data.unread !== undefined && data.unread !== null) {
+      setConversationBadge(li, data.unread);
+    } else if (Number(data.delta || 0) && !isActive && String(data.sender_id || "") !== String(currentUserId)) {
+      setConversationBadge(li, Number(li.getAttribute("data-unread") || 0) + Number(data.delta));
+    }
+    if (data.last_ts) bumpConversation(kind, data.id, data.last_ts);
+  }
+
   function updateConversationFlags(li){
     if(!li) return;
     const pin = li.querySelector('.flag-pin');
@@ -1788,7 +2017,6 @@
     } else {
       if (isGroup && msg.group_id) bumpConversation("group", msg.group_id, msg.timestamp_ms);
       if (!isGroup) bumpConversation("user", msg.sender_id, msg.timestamp_ms);
-      refreshSidebarBadges();
       if (document.hidden) {
         const senderName = msg.sender_name || document.querySelector(`li[data-user-id="${msg.sender_id}"]`)?.getAttribute("data-name") || "مستخدم";
         showNotification(senderName, msg.content, msg.id);
@@ -1827,15 +2055,21 @@
     if (socket) return;
     socket = window.io({ transports: ["websocket", "polling"] });
     socket.on("connect", () => {
+      const isReconnect = socketEverConnected;
+      socketEverConnected = true;
       socketConnected = true;
       const groupIds = getInitialGroupIds();
       joinGroupRooms(groupIds);
       renderNetStatus();
+      stopBadgePolling();
+      // Deltas sent while we were offline are lost: resync once
+      if (isReconnect) refreshSidebarBadges();
     });
     socket.on("disconnect", () => {
       socketConnected = false;
       setTypingIndicator("");
       renderNetStatus();
+      if (badgeRefreshEnabled && !document.hidden) startBadgePolling();
     });
     socket.on("presence_state", (data) => {
       const ids = Array.isArray(data?.online_user_ids) ? data.online_user_ids : [];
@@ -1905,6 +2139,31 @@
         }
       } catch (_) {}
     });
+    socket.on("message_media", (data) => {
+      try {
+        if (!data || !data.message_id || !data.thumb_url) return;
+        const t = data.type === "group" ? "group" : "dm";
+        const id = String(data.message_id);
+        const fields = {
+          thumb_url: data.thumb_url,
+          preview_url: data.preview_url,
+          media_width: data.media_width,
+          media_height: data.media_height,
+        };
+        const cached = getMsgFromCache(t, id);
+        if (cached) Object.assign(cached, fields);
+        // Only the open conversation is on screen; ids of dm and group messages overlap
+        if ((t === "group") !== Boolean(currentGroupId)) return;
+        const img = messagesDiv.querySelector(`.message[data-msg-id="${CSS.escape(id)}"] img.msg-image`);
+        if (!img) return;
+        if (fields.media_width && fields.media_height) {
+          img.width = Number(fields.media_width);
+          img.height = Number(fields.media_height);
+        }
+        img.src = fields.thumb_url;
+        if (fields.preview_url) img.srcset = `${fields.thumb_url} 1x, ${fields.preview_url} 2x`;
+      } catch (_) {}
+    });
     socket.on("message_deleted", (data) => {
       try {
         if (!data || !data.message_id) return;
@@ -1919,6 +2178,7 @@
         el.innerHTML = buildMessageInner(msg, isSent);
       } catch (_) {}
     });
+    socket.on("unread_delta", applyUnreadDelta);
     socket.on("refresh_unread", () => refreshSidebarBadges());
   }
 
@@ -1948,6 +2208,8 @@
     displayedMessages.clear();
     lastMessageTimestamp = 0;
     lastMessageId = 0;
+    oldestMessageId = 0;
+    hasMoreOlder = false;
     lastDate = null;
     suppressSound = true;
     initialPaintDone = false;
@@ -2016,6 +2278,34 @@
   }
 
   // ====== Send Message ======
+  // Text goes over the open socket (the ack carries the stored message) and falls
+  // back to HTTP. Both carry the same client_msg_id, so a retry never stores twice.
+  function newClientMsgId() {
+    if (window.crypto?.randomUUID) return window.crypto.randomUUID();
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+  }
+
+  function emitSendMessage(fields) {
+    return new Promise((resolve) => {
+      socket.timeout(SEND_ACK_TIMEOUT_MS).emit("send_message", fields, (err, ack) => resolve(err ? null : ack));
+    });
+  }
+
+  async function postTextMessage(fields) {
+    if (socket && socketConnected) {
+      const ack = await emitSendMessage(fields);
+      // No ack in time, or a session the socket no longer knows: retry over HTTP
+      if (ack && ack.status_code !== 401) return ack;
+    }
+    const formData = new FormData();
+    Object.entries(fields).forEach(([k, v]) => {
+      if (v !== undefined && v !== null && v !== "") formData.append(k, v);
+    });
+    const endpoint = fields.group_id ? "/send_group_message" : "/send_message";
+    const res = await fetch(endpoint, { method: "POST", body: formData });
+    return res.json().catch(() => ({}));
+  }
+
   async function sendMessage(e) {
     if (e) e.preventDefault();
     if (!currentReceiverId && !currentGroupId) return;
@@ -2085,19 +2375,11 @@
     else bumpConversation("user", currentReceiverId, tempMsg.timestamp_ms);
 
     try {
-      const formData = new FormData();
-      formData.append("content", content);
-      if (replyToId) formData.append("reply_to_id", replyToId);
-      let endpoint = "/send_message";
-      if (currentGroupId) {
-        endpoint = "/send_group_message";
-        formData.append("group_id", currentGroupId);
-      } else {
-        formData.append("receiver_id", currentReceiverId);
-      }
-      const res = await fetch(endpoint, { method: "POST", body: formData });
-      const data = await res.json().catch(() => ({}));
-      if (res.ok && data?.status === "ok" && data.message) {
+      const fields = { client_id: tempId, client_msg_id: newClientMsgId(), content, reply_to_id: replyToId };
+      if (currentGroupId) fields.group_id = currentGroupId;
+      else fields.receiver_id = currentReceiverId;
+      const data = await postTextMessage(fields);
+      if (data?.status === "ok" && data.message) {
         const realId = String(data.message.id);
         const tempDiv = document.querySelector(`div[data-msg-id="${tempId}"]`);
         if (tempDiv) tempDiv.dataset.msgId = realId;
@@ -2371,10 +2653,7 @@
       stopBadgePolling();
       return;
     }
-    if (badgeRefreshEnabled) {
-      startBadgePolling();
-      refreshSidebarBadges();
-    }
+    if (badgeRefreshEnabled && !socketConnected) startBadgePolling();
     if (!document.hidden && (currentReceiverId || currentGroupId)) {
       suppressSound = true;
       initialPaintDone = false;
@@ -3033,6 +3312,13 @@
     initConversationContextMenu();
     initSearchModalUI();
 
+    // Sidebar: first page now, further pages when scrolling near the end
+    loadConversations();
+    document.getElementById("users-list")?.addEventListener("scroll", (ev) => {
+      const ul = ev.currentTarget;
+      if (ul.scrollHeight - ul.scrollTop - ul.clientHeight < 200) loadConversations();
+    }, { passive: true });
+
     // --- Push Notifications Auto-Setup (Best Effort) ---
     // The goal is to keep background notifications reliable even if the tab/app is closed.
     // Web Push still requires:
@@ -3091,6 +3377,11 @@
     registerServiceWorkerIfNeeded();
     updateGroupActionsVisibility();
 
+    // Scroll back through history: fetch the previous page when reaching the top
+    messagesDiv.addEventListener("scroll", () => {
+      if (messagesDiv.scrollTop < 80) loadOlderMessages();
+    }, { passive: true });
+
     
     if (receiverInput.value || groupInput.value) {
       if (groupInput.value) {
@@ -3119,7 +3410,7 @@
     badgePollTimeoutId = setTimeout(() => {
       badgeRefreshEnabled = true;
       refreshSidebarBadges();
-      startBadgePolling();
+      if (!socketConnected) startBadgePolling();
     }, BADGE_POLL_DELAY_MS);
     renderNetStatus();
   });